@@ -0,0 +1,234 @@
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import timeit
+
+import rust2rpm
+from rust2rpm.__main__ import get_crate_kwargs, get_jinja_env, get_target_kwargs
+from rust2rpm.metadata import VersionIndex
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+# A benchmark fails when it gets slower than baseline * TOLERANCE
+TOLERANCE = 1.5
+
+REQS = ["^1.0", "^0.2", "*", "~1.2.3", "=1.0.0", ">= 1.2, < 1.5", "1.*",
+        "^0.0.3", "1.2.3-beta", "^0.4.1", "~0.3", "> 1", "< 2"]
+
+def make_manifest(name, ndeps, nfeatures=20, seed=0):
+    # Same shape as `cargo read-manifest` output
+    rng = random.Random(seed)
+    deps = []
+    for i in range(ndeps):
+        deps.append({
+            "name": "dep{}".format(i),
+            "req": rng.choice(REQS),
+            "kind": rng.choice([None, None, None, "dev", "build"]),
+            "rename": None,
+            "optional": rng.random() < 0.3,
+            "uses_default_features": True,
+            "features": ["feat{}".format(j) for j in range(rng.randint(0, 3))],
+            "target": None,
+        })
+    return {
+        "name": name,
+        "version": "1.{}.0".format(seed % 100),
+        "license": "MIT OR Apache-2.0",
+        "license_file": None,
+        "description": "Synthetic crate with {} dependencies".format(ndeps),
+        "dependencies": deps,
+        "targets": [{"kind": ["lib"], "name": name.replace("-", "_")},
+                    {"kind": ["bin"], "name": name}],
+        "features": {"feature{}".format(i): [] for i in range(nfeatures)},
+    }
+
+def bench_parse_req():
+    parse = rust2rpm.Dependency._parse_req.__wrapped__
+    for req in REQS:
+        parse(req)
+
+def bench_render():
+    render = rust2rpm.Dependency._render.__wrapped__
+    for req in REQS:
+        render("dep", req, ("std", "serde"), False)
+
+def make_from_json(manifest):
+    def bench():
+        rust2rpm.Dependency.cache_clear()
+        # Dependencies are built lazily, include them
+        rust2rpm.Metadata.from_json(manifest).requires
+    return bench
+
+def make_spec_render(manifest):
+    template = get_jinja_env().get_template("main.spec")
+    target_kwargs = get_target_kwargs("plain")
+    target_kwargs["packager"] = "Bench <bench@example.com>"
+    metadata = rust2rpm.Metadata.from_json(manifest)
+
+    def bench():
+        kwargs = dict(target_kwargs)
+        kwargs.update(get_crate_kwargs(metadata))
+        template.render(md=metadata, patch_file=None, **kwargs)
+    return bench
+
+def make_registry(count):
+    # Metadata for a registry scan, with the requirements the resolver reads
+    manifests = [make_manifest("crate{}".format(i), 10, nfeatures=5, seed=i)
+                 for i in range(count)]
+
+    def bench():
+        rust2rpm.Dependency.cache_clear()
+        for manifest in manifests:
+            rust2rpm.Metadata.from_json(manifest).requires
+    return bench
+
+def make_version_match(count, nversions=50):
+    # Newest match of every REQS entry in count crates, as the resolver does
+    rng = random.Random(count)
+    crates = []
+    for _ in range(count):
+        versions = set()
+        while len(versions) < nversions:
+            version = "{}.{}.{}".format(rng.randint(0, 2), rng.randint(0, 9), rng.randint(0, 9))
+            if rng.random() < 0.1:
+                version += "-rc.{}".format(rng.randint(1, 3))
+            versions.add(version)
+        crates.append(sorted(versions))
+    specs = [rust2rpm.Dependency("dep", req).spec for req in REQS]
+
+    def bench():
+        for versions in crates:
+            index = VersionIndex(versions)
+            for spec in specs:
+                index.best(spec)
+    return bench
+
+def retain_metadata(count, evaluate=False):
+    # Peak RSS (KiB) of a process keeping count Metadata objects around
+    mds = []
+    for i in range(count):
+        md = rust2rpm.Metadata.from_json(make_manifest("crate{}".format(i), 10, nfeatures=5, seed=i))
+        if evaluate:
+            md.requires
+        mds.append(md)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def measure_memory(count, evaluate=False):
+    # Run in a fresh interpreter, so earlier benchmarks don't raise the peak
+    argv = [sys.executable, os.path.abspath(__file__), "--memory-run", str(count)]
+    if evaluate:
+        argv.append("--evaluate")
+    return int(subprocess.check_output(argv, universal_newlines=True))
+
+def memory_benchmarks():
+    # name -> (count, evaluate); the result is KiB above an empty run
+    return [
+        ("memory_10k", 10000, False),
+        ("memory_10k_evaluated", 10000, True),
+    ]
+
+def benchmarks():
+    # name -> (callable, number of calls per measurement)
+    return [
+        ("parse_req", bench_parse_req, 200),
+        ("render_dependency", bench_render, 200),
+        ("from_json_1", make_from_json(make_manifest("small", 1)), 200),
+        ("from_json_50", make_from_json(make_manifest("medium", 50)), 20),
+        ("from_json_500", make_from_json(make_manifest("large", 500)), 2),
+        ("render_spec_1", make_spec_render(make_manifest("small", 1)), 20),
+        ("render_spec_500", make_spec_render(make_manifest("large", 500)), 2),
+        ("registry_10k", make_registry(10000), 1),
+        ("version_match_1k", make_version_match(1000), 1),
+    ]
+
+# Times are stored as multiples of this loop, measured right after each
+# benchmark in the same process, so a baseline holds on other machines
+def calibrate():
+    # Plain interpreter work: string formatting, dict lookups, small tuples
+    counts = {}
+    for i in range(2000):
+        key = "dep{}".format(i % 100)
+        counts[key] = counts.get(key, 0) + len((key, i))
+    return counts
+
+def measure(func, number, repeat):
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+def measure_calibrated(func, number, repeat):
+    # (seconds per call, multiple of the calibration loop)
+    t = measure(func, number, repeat)
+    return t, t / measure(calibrate, 20, repeat)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--update", action="store_true",
+                        help="Store the measured times as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="Allowed slowdown factor against the baseline")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("-k", metavar="NAME", help="Only run benchmarks containing NAME")
+    parser.add_argument("--memory", action="store_true",
+                        help="Measure peak RSS of retained metadata instead of time")
+    parser.add_argument("--memory-run", type=int, metavar="COUNT", help=argparse.SUPPRESS)
+    parser.add_argument("--evaluate", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.memory_run is not None:
+        print(retain_metadata(args.memory_run, args.evaluate))
+        return
+
+    section = "memory" if args.memory else "time"
+    baseline = {}
+    if os.path.isfile(BASELINE):
+        with open(BASELINE, "r") as fobj:
+            baseline = json.load(fobj)
+    if not isinstance(baseline.get(section), dict):
+        # Without a baseline in this format, everything is new
+        baseline[section] = {}
+
+    results = {}
+    regressions = []
+    if args.memory:
+        empty = measure_memory(0)
+        runs = [(name, lambda count=count, evaluate=evaluate:
+                 ((measure_memory(count, evaluate) - empty) / 1024,) * 2)
+                for name, count, evaluate in memory_benchmarks()]
+        unit, scale, compared = "MiB", 1, "MiB"
+    else:
+        runs = [(name, lambda func=func, number=number:
+                 measure_calibrated(func, number, args.repeat))
+                for name, func, number in benchmarks()]
+        unit, scale, compared = "us", 1e6, "cal"
+    for name, run in runs:
+        if args.k and args.k not in name:
+            continue
+        t, value = run()
+        results[name] = value
+        base = baseline[section].get(name)
+        if base is None:
+            status = "new"
+        elif value > base * args.tolerance:
+            status = "REGRESSION"
+            regressions.append(name)
+        else:
+            status = "ok"
+        print("{:<20} {:>12.1f} {unit}  {:>10.2f} {compared}  baseline {:>10} {compared}  "
+              "{:.2f}x  {}".format(
+              name, t * scale, value, "-" if base is None else "{:.2f}".format(base),
+              value / base if base else 0, status, unit=unit, compared=compared))
+
+    if args.update:
+        baseline[section].update(results)
+        with open(BASELINE, "w") as fobj:
+            json.dump(baseline, fobj, indent=2, sort_keys=True)
+            fobj.write("\n")
+    elif regressions:
+        print("\nPerformance regressions (more than {}x slower than baseline): {}".format(
+              args.tolerance, ", ".join(regressions)), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
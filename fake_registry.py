@@ -0,0 +1,189 @@
+import argparse
+import hashlib
+import http.server
+import io
+import itertools
+import json
+import random
+import socketserver
+import tarfile
+import threading
+
+import semantic_version as semver
+
+# Stand-in for the parts of crates.io rust2rpm talks to:
+#   /api/v1/crates/{name}/versions
+#   /api/v1/crates/{name}/{version}/download
+#   /index/{prefix}/{name}            (sparse index, with ETag support)
+
+def make_toml(name, version, deps=()):
+    toml = '[package]\nname = "{}"\nversion = "{}"\n'.format(name, version)
+    if deps:
+        toml += "\n[dependencies]\n"
+        toml += "".join('{} = "{}"\n'.format(dep, req) for dep, req in deps)
+    return toml
+
+def make_crate(name, version, toml=None, files=(), padding=0, seed=0):
+    # padding adds an incompressible vendored blob of that many bytes
+    if toml is None:
+        toml = make_toml(name, version)
+    files = list(files)
+    if padding:
+        rng = random.Random(seed)
+        files.append(("vendor/blob.bin", rng.getrandbits(8 * padding).to_bytes(padding, "little")))
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as archive:
+        for path, contents in itertools.chain([("Cargo.toml", toml)], files):
+            data = contents.encode("utf-8") if isinstance(contents, str) else contents
+            info = tarfile.TarInfo("{}-{}/{}".format(name, version, path))
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # http.server.ThreadingHTTPServer only exists since Python 3.7
+    daemon_threads = True
+
+class FakeRegistry(object):
+    def __init__(self):
+        self.crates = {}
+        self.deps = {}
+        self.hits = []
+        self._server = None
+        self._thread = None
+
+    def add(self, name, version, deps=(), **kwargs):
+        if "toml" not in kwargs:
+            kwargs["toml"] = make_toml(name, version, deps)
+        self.crates.setdefault(name, {})[version] = make_crate(name, version, **kwargs)
+        self.deps.setdefault(name, {})[version] = list(deps)
+
+    def versions(self, name):
+        return sorted(self.crates.get(name, {}), key=semver.Version, reverse=True)
+
+    def index_file(self, name):
+        lines = []
+        for version in reversed(self.versions(name)):
+            deps = [{"name": dep, "req": req, "features": [], "optional": False,
+                     "default_features": True, "target": None, "kind": "normal"}
+                    for dep, req in self.deps[name][version]]
+            lines.append(json.dumps({
+                "name": name, "vers": version, "deps": deps,
+                "cksum": hashlib.sha256(self.crates[name][version]).hexdigest(),
+                "features": {}, "yanked": False}))
+        return "".join(line + "\n" for line in lines).encode("utf-8")
+
+    def handler(self):
+        registry = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def reply(self, body, headers=()):
+                self.send_response(200)
+                for header in headers:
+                    self.send_header(*header)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def download(self, body):
+                # Only the "bytes=N-" form rust2rpm sends when resuming
+                offset = self.headers.get("Range", "bytes=0-")[len("bytes="):].rstrip("-")
+                offset = int(offset or 0)
+                if offset == 0:
+                    self.reply(body)
+                elif offset >= len(body):
+                    self.send_error(416)
+                else:
+                    self.send_response(206)
+                    self.send_header("Content-Range", "bytes {}-{}/{}".format(
+                                     offset, len(body) - 1, len(body)))
+                    self.send_header("Content-Length", str(len(body) - offset))
+                    self.end_headers()
+                    self.wfile.write(body[offset:])
+
+            def do_GET(self):
+                registry.hits.append(self.path)
+                parts = self.path.split("/")
+                crates = registry.crates
+                if parts[1] == "index" and parts[-1] in crates:
+                    body = registry.index_file(parts[-1])
+                    etag = '"{}"'.format(hashlib.sha256(body).hexdigest())
+                    if self.headers.get("If-None-Match") == etag:
+                        self.send_response(304)
+                        self.end_headers()
+                    else:
+                        self.reply(body, [("ETag", etag)])
+                elif len(parts) == 6 and parts[5] == "versions" and parts[4] in crates:
+                    versions = [{"num": v, "yanked": False,
+                                 "checksum": hashlib.sha256(crates[parts[4]][v]).hexdigest()}
+                                for v in registry.versions(parts[4])]
+                    self.reply(json.dumps({"versions": versions}).encode("utf-8"))
+                elif len(parts) == 7 and parts[6] == "download" and \
+                     parts[5] in crates.get(parts[4], {}):
+                    self.download(crates[parts[4]][parts[5]])
+                else:
+                    self.send_error(404)
+
+        return Handler
+
+    def start(self, host="127.0.0.1", port=0):
+        self._server = ThreadingHTTPServer((host, port), self.handler())
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return "http://{}:{}/".format(host, port)
+
+    @property
+    def api_url(self):
+        return self.url + "api/v1/"
+
+    @property
+    def index_url(self):
+        return self.url + "index/"
+
+def populate(registry, count, min_size=0, max_size=256 * 1024, seed=0):
+    # Every crate depends on up to three earlier ones
+    rng = random.Random(seed)
+    names = []
+    for i in range(count):
+        name = "crate{}".format(i)
+        deps = [(dep, "^1") for dep in rng.sample(names, min(len(names), rng.randint(0, 3)))]
+        registry.add(name, "1.0.{}".format(i % 10), deps=deps,
+                     files=[("src/lib.rs", "pub fn f() {}\n")],
+                     padding=rng.randint(min_size, max_size), seed=i)
+        names.append(name)
+    return names
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--crates", type=int, default=100,
+                        help="Number of synthetic crates to serve")
+    parser.add_argument("--max-size", type=int, default=256 * 1024,
+                        help="Largest synthetic crate payload in bytes")
+    args = parser.parse_args()
+
+    registry = FakeRegistry()
+    populate(registry, args.crates, max_size=args.max_size)
+    registry.start(port=args.port)
+    print("API:   {}".format(registry.api_url))
+    print("Index: {}".format(registry.index_url))
+    try:
+        registry._thread.join()
+    except KeyboardInterrupt:
+        registry.stop()
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,14 @@
-from .metadata import *
+import sys
+
+__all__ = ["Dependency", "Metadata"]
+
+# Loading the metadata module pulls in semantic_version and the TOML parser,
+# which the cargo-inspector-client does not need.
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        if name in __all__:
+            from . import metadata
+            return getattr(metadata, name)
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+else:
+    from .metadata import *
@@ -10,21 +10,28 @@ import tarfile
 import tempfile
 import time
 import subprocess
+import sys
 
-import jinja2
-import requests
-import tqdm
+import semantic_version as semver
 
-from . import Metadata
+from . import Metadata, timing
+from .cache import MetadataCache, crate_key
+from .capabilities import Capabilities
+from .metadata import (UnsupportedManifest, add_feature_arguments, crate_read_manifest,
+                       drop_foreign_targets, feature_kwargs, load_manifest)
+from .registry import API_URL, DEFAULT_JOBS, INDEX_URL, Downloader, Index
+from .resolver import Resolver
+from .update import update_spec
 
 DEFAULT_EDITOR = "vi"
-XDG_CACHE_HOME = os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
-CACHEDIR = os.path.join(XDG_CACHE_HOME, "rust2rpm")
-API_URL = "https://crates.io/api/v1/"
-JINJA_ENV = jinja2.Environment(loader=jinja2.ChoiceLoader([
-                               jinja2.FileSystemLoader(['/']),
-                               jinja2.PackageLoader('rust2rpm', 'templates'), ]),
-                               trim_blocks=True, lstrip_blocks=True)
+API_URL_ENV = "RUST2RPM_API_URL"
+
+def get_jinja_env():
+    import jinja2
+    return jinja2.Environment(loader=jinja2.ChoiceLoader([
+                              jinja2.FileSystemLoader(['/']),
+                              jinja2.PackageLoader('rust2rpm', 'templates'), ]),
+                              trim_blocks=True, lstrip_blocks=True)
 
 def get_default_target():
     # TODO: add fallback for /usr/lib/os-release
@@ -71,8 +78,11 @@ def detect_packager():
 
     git = shutil.which("git")
     if git is not None:
-        name = subprocess.check_output([git, "config", "user.name"], universal_newlines=True).strip()
-        email = subprocess.check_output([git, "config", "user.email"], universal_newlines=True).strip()
+        try:
+            name = subprocess.check_output([git, "config", "user.name"], universal_newlines=True).strip()
+            email = subprocess.check_output([git, "config", "user.email"], universal_newlines=True).strip()
+        except subprocess.CalledProcessError:
+            return None
         return "{} <{}>".format(name, email)
 
     return None
@@ -81,29 +91,14 @@ def file_mtime(path):
     t = datetime.fromtimestamp(os.stat(path).st_mtime, timezone.utc)
     return t.astimezone().isoformat()
 
-def download(crate, version):
-    if version is None:
-        # Now we need to get latest version
-        url = requests.compat.urljoin(API_URL, "crates/{}/versions".format(crate))
-        req = requests.get(url)
-        req.raise_for_status()
-        versions = req.json()["versions"]
-        version = next(version["num"] for version in versions if not version["yanked"])
-
-    if not os.path.isdir(CACHEDIR):
-        os.mkdir(CACHEDIR)
-    cratef_base = "{}-{}.crate".format(crate, version)
-    cratef = os.path.join(CACHEDIR, cratef_base)
-    if not os.path.isfile(cratef):
-        url = requests.compat.urljoin(API_URL, "crates/{}/{}/download#".format(crate, version))
-        req = requests.get(url, stream=True)
-        req.raise_for_status()
-        total = int(req.headers["Content-Length"])
-        with open(cratef, "wb") as f:
-            for chunk in tqdm.tqdm(req.iter_content(), "Downloading {}".format(cratef_base),
-                                   total=total, unit="B", unit_scale=True):
-                f.write(chunk)
-    return cratef, crate, version
+def make_downloader(args):
+    index = None
+    if args.index:
+        index = Index(args.index, offline=args.offline)
+    return Downloader(api_url=args.api_url, jobs=args.jobs, index=index)
+
+def download(crate, version, downloader=None):
+    return (downloader or Downloader()).fetch(crate, version)
 
 def local(crate, version):
     if version != None:
@@ -114,42 +109,33 @@ def local(crate, version):
     cratef = crate
     return cratef, cratename, version
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-", "--stdout", action="store_true",
-                        help="Print spec and patches into stdout")
-    parser.add_argument("-t", "--target", action="store",
-                        choices=("plain", "fedora", "mageia", "opensuse"), default=get_default_target(),
-                        help="Distribution target")
-    parser.add_argument("-p", "--patch", action="store_true",
-                        help="Do initial patching of Cargo.toml")
-    parser.add_argument("crate", help="crates.io name")
-    parser.add_argument("version", nargs="?", help="crates.io version")
-    args = parser.parse_args()
-
-    if args.patch:
-        editor = detect_editor()
-
-    if os.path.isfile(args.crate) and args.crate.endswith('.crate'):
-        cratef,crate,version = local(args.crate, args.version)
-    else:
-        cratef,crate,version = download(args.crate, args.version)
+def read_crate(cratef, crate, version, editor=None):
+    # Full extraction is only needed to let the packager edit Cargo.toml
+    if editor is None:
+        try:
+            return crate_read_manifest(cratef, "{}-{}".format(crate, version)), None
+        except UnsupportedManifest:
+            pass
 
+    diff = None
     with tempfile.TemporaryDirectory() as tmpdir:
         target_dir = "{}/".format(tmpdir)
-        with tarfile.open(cratef, "r") as archive:
-            for n in archive.getnames():
-                if not os.path.abspath(os.path.join(target_dir, n)).startswith(target_dir):
+        with timing.TIMINGS.phase("extract"), tarfile.open(cratef, "r") as archive:
+            for member in archive.getmembers():
+                if not os.path.abspath(os.path.join(target_dir, member.name)).startswith(target_dir):
                     raise Exception("Unsafe filenames!")
+                timing.TIMINGS.add_bytes("extract", member.size)
             archive.extractall(target_dir)
         toml_relpath = "{}-{}/Cargo.toml".format(crate, version)
         toml = "{}/{}".format(tmpdir, toml_relpath)
         assert os.path.isfile(toml)
 
-        if args.patch:
+        if editor is not None:
             mtime_before = file_mtime(toml)
             with open(toml, "r") as fobj:
                 toml_before = fobj.readlines()
+            with open(toml, "w") as fobj:
+                fobj.write(drop_foreign_targets("".join(toml_before)))
             subprocess.check_call([editor, toml])
             mtime_after = file_mtime(toml)
             with open(toml, "r") as fobj:
@@ -158,60 +144,100 @@ def main():
                                              fromfile=toml_relpath, tofile=toml_relpath,
                                              fromfiledate=mtime_before, tofiledate=mtime_after))
 
-        metadata = Metadata.from_file(toml)
-
-    template = JINJA_ENV.get_template("main.spec")
+        return load_manifest(toml), diff
 
-    if args.patch and len(diff) > 0:
-        patch_file = "{}-{}-fix-metadata.diff".format(crate, version)
-    else:
-        patch_file = None
+def foreign_targets_patch(cratef, crate, version):
+    # The patch file name and diff dropping dependencies of platforms outside
+    # %rust_arches from Cargo.toml, (None, None) if there are none
+    toml_relpath = "{}-{}/Cargo.toml".format(crate, version)
+    with tarfile.open(cratef, "r") as archive:
+        toml_before = archive.extractfile(toml_relpath).read().decode("utf-8")
+    toml_after = drop_foreign_targets(toml_before)
+    if toml_after == toml_before:
+        return None, None
+    diff = list(difflib.unified_diff(toml_before.splitlines(True), toml_after.splitlines(True),
+                                     fromfile=toml_relpath, tofile=toml_relpath))
+    return "{}-{}-fix-metadata.diff".format(crate, version), diff
 
+def get_target_kwargs(target):
     kwargs = {}
-    kwargs["target"] = args.target
-    bins = [tgt for tgt in metadata.targets if tgt.kind == "bin"]
-    libs = [tgt for tgt in metadata.targets if tgt.kind in ("lib", "rlib", "proc-macro")]
-    is_bin = len(bins) > 0
-    is_lib = len(libs) > 0
-    if is_bin:
-        kwargs["include_main"] = True
-        kwargs["bins"] = bins
-    elif is_lib:
-        kwargs["include_main"] = False
-    else:
-        raise ValueError("No bins and no libs")
-    kwargs["include_devel"] = is_lib
+    kwargs["target"] = target
 
-    if args.target in ("fedora", "mageia", "opensuse"):
+    if target in ("fedora", "mageia", "opensuse"):
         kwargs["include_build_requires"] = True
         kwargs["include_provides"] = False
         kwargs["include_requires"] = False
-    elif args.target == "plain":
+    elif target == "plain":
         kwargs["include_build_requires"] = True
         kwargs["include_provides"] = True
         kwargs["include_requires"] = True
     else:
-        assert False, "Unknown target {!r}".format(args.target)
+        assert False, "Unknown target {!r}".format(target)
 
-    if args.target == "mageia":
+    if target == "mageia":
         kwargs["pkg_release"] = "%mkrel 1"
         kwargs["rust_group"] = "Development/Rust"
-    elif args.target == "opensuse":
+    elif target == "opensuse":
         kwargs["spec_copyright_year"] = time.strftime("%Y")
         kwargs["pkg_release"] = "0"
         kwargs["rust_group"] = "Development/Libraries/Rust"
     else:
         kwargs["pkg_release"] = "1%{?dist}"
 
-    if args.target == "opensuse":
+    if target == "opensuse":
         kwargs["date"] = time.strftime("%a %b %d %T %Z %Y")
     else:
         kwargs["date"] = time.strftime("%a %b %d %Y")
     kwargs["packager"] = detect_packager()
+    kwargs["arch_conditional"] = False
+
+    return kwargs
+
+def get_crate_kwargs(metadata):
+    kwargs = {}
+    bins = [tgt for tgt in metadata.targets if tgt.kind == "bin"]
+    libs = [tgt for tgt in metadata.targets if tgt.kind in ("lib", "rlib", "proc-macro")]
+    is_bin = len(bins) > 0
+    is_lib = len(libs) > 0
+    if is_bin:
+        kwargs["include_main"] = True
+        kwargs["bins"] = bins
+    elif is_lib:
+        kwargs["include_main"] = False
+    else:
+        raise ValueError("No bins and no libs")
+    kwargs["include_devel"] = is_lib
+    return kwargs
+
+@timing.timed("render")
+def render_spec(template, metadata, target_kwargs, patch_file=None, compat_suffix=""):
+    # compat_suffix ("0.1") names the package of an older compatible series
+    kwargs = dict(target_kwargs)
+    kwargs.update(get_crate_kwargs(metadata))
+    return template.render(md=metadata, patch_file=patch_file, compat_suffix=compat_suffix,
+                           **kwargs)
+
+def fetch_crate(crate, version, downloader=None):
+    if os.path.isfile(crate) and crate.endswith('.crate'):
+        return local(crate, version)
+    else:
+        return download(crate, version, downloader)
+
+def make_changelog(template, metadata, target_kwargs):
+    def changelog(release, changes):
+        return template.render(md=metadata, release=release, changes=changes, **target_kwargs)
+    return changelog
 
+def write_spec(crate, spec_contents, stdout=False, patch_file=None, diff=None, changelog=None):
+    # With changelog, an existing spec file is updated in place instead
     spec_file = "rust-{}.spec".format(crate)
-    spec_contents = template.render(md=metadata, patch_file=patch_file, **kwargs)
-    if args.stdout:
+    if changelog is not None and os.path.isfile(spec_file):
+        with open(spec_file, "r") as fobj:
+            spec_contents, changed = update_spec(fobj.read(), spec_contents, changelog)
+        spec_contents = spec_contents.rstrip("\n")
+        if not changed and not stdout:
+            return
+    if stdout:
         print("# {}".format(spec_file))
         print(spec_contents)
         if patch_file is not None:
@@ -225,5 +251,217 @@ def main():
             with open(patch_file, "w") as fobj:
                 fobj.writelines(diff)
 
+def load_metadata(cratef, crate, version, cache=None, **kwargs):
+    if cache is None:
+        return Metadata.from_json(read_crate(cratef, crate, version)[0], **kwargs)
+    return cache.load(crate_key(cratef), lambda: read_crate(cratef, crate, version)[0], **kwargs)
+
+def report_unsatisfied(crate, metadata, capabilities):
+    # Returns the number of BuildRequires nothing in capabilities provides
+    unsatisfied = capabilities.unsatisfied(itertools.chain(
+        metadata.enabled_requires, metadata.enabled_build_requires, metadata.test_requires))
+    for dep in unsatisfied:
+        print("warning: rust-{}.spec: nothing provides {}".format(crate, dep), file=sys.stderr)
+    return len(unsatisfied)
+
+def read_batch(fobj):
+    for line in fobj:
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        crate, _, version = line.partition("@")
+        yield crate, version or None
+
+def batch(args, template, target_kwargs, changelog_template=None, capabilities=None):
+    if args.batch == "-":
+        entries = list(read_batch(sys.stdin))
+    else:
+        with open(args.batch, "r") as fobj:
+            entries = list(read_batch(fobj))
+
+    remote = [(crate, version) for crate, version in entries
+              if not (os.path.isfile(crate) and crate.endswith(".crate"))]
+    fetched = dict(zip(remote, make_downloader(args).fetch_many(remote)))
+
+    cache = None if args.no_cache else MetadataCache()
+    failures = []
+    for crate, version in entries:
+        try:
+            if (crate, version) in fetched:
+                result = fetched[(crate, version)]
+                if isinstance(result, Exception):
+                    raise result
+                cratef, crate, version = result
+            else:
+                cratef, crate, version = local(crate, version)
+            metadata = load_metadata(cratef, crate, version, cache, **feature_kwargs(args))
+            patch_file, diff = foreign_targets_patch(cratef, crate, version)
+            spec_contents = render_spec(template, metadata, target_kwargs, patch_file)
+            changelog = None
+            if changelog_template is not None:
+                changelog = make_changelog(changelog_template, metadata, target_kwargs)
+            write_spec(crate, spec_contents, stdout=args.stdout, patch_file=patch_file, diff=diff,
+                       changelog=changelog)
+            if capabilities is not None:
+                report_unsatisfied(crate, metadata, capabilities)
+        except Exception as e:
+            failures.append((crate if version is None else "{}@{}".format(crate, version), e))
+
+    print("Generated {} of {} spec files".format(len(entries) - len(failures), len(entries)),
+          file=sys.stderr)
+    for entry, e in failures:
+        print("  {}: {}".format(entry, e), file=sys.stderr)
+    if failures:
+        sys.exit(1)
+
+def recursive(args, template, target_kwargs, changelog_template=None, capabilities=None):
+    cache = None if args.no_cache else MetadataCache()
+    resolver = Resolver(make_downloader(args),
+                        lambda *crate, **kwargs: load_metadata(*crate, cache=cache, **kwargs),
+                        jobs=args.jobs)
+    resolver.resolve(args.crate, args.version, **feature_kwargs(args))
+    order = resolver.build_order()
+    for warning in resolver.warnings:
+        print("warning: {}".format(warning), file=sys.stderr)
+
+    newest = {}
+    for node in order:
+        if node.name not in newest or \
+           semver.Version(node.version) > semver.Version(newest[node.name].version):
+            newest[node.name] = node
+
+    print("Build order:", file=sys.stderr)
+    for node in order:
+        suffix = ""
+        if newest[node.name] is not node:
+            # Older compatible series get their own package
+            suffix = node.key[1]
+        name = node.name + suffix
+        print("  rust-{}.spec ({})".format(name, node.version), file=sys.stderr)
+        changelog = None
+        if changelog_template is not None:
+            changelog = make_changelog(changelog_template, node.metadata, target_kwargs)
+        patch_file, diff = foreign_targets_patch(node.cratef, node.name, node.version)
+        write_spec(name, render_spec(template, node.metadata, target_kwargs, patch_file,
+                                     compat_suffix=suffix),
+                   stdout=args.stdout, patch_file=patch_file, diff=diff, changelog=changelog)
+        if capabilities is not None:
+            report_unsatisfied(name, node.metadata, capabilities)
+            # Built before whatever comes later in the order
+            for provide in node.metadata.provides:
+                capabilities.add_provide(provide)
+
+def main():
+    if sys.argv[1:2] == ["install"]:
+        from .install import main as install_main
+        install_main(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ["capabilities"]:
+        from .capabilities import main as capabilities_main
+        capabilities_main(sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(epilog="Use `rust2rpm install --help` for installing "
+                                            "a crate into the cargo registry and "
+                                            "`rust2rpm capabilities --help` for building "
+                                            "the index used by --capabilities.")
+    parser.add_argument("-", "--stdout", action="store_true",
+                        help="Print spec and patches into stdout")
+    parser.add_argument("-t", "--target", action="store",
+                        choices=("plain", "fedora", "mageia", "opensuse"),
+                        help="Distribution target (default: detected from os-release)")
+    parser.add_argument("-p", "--patch", action="store_true",
+                        help="Do initial patching of Cargo.toml")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Do not use the crate metadata cache")
+    parser.add_argument("--arch-conditional", action="store_true",
+                        help="Wrap BuildRequires needed only on some of %%{rust_arches} in %%ifarch")
+    parser.add_argument("-u", "--update", action="store_true",
+                        help="Update existing spec files: only Version, Release, the crate "
+                             "dependencies and a new changelog entry are rewritten")
+    parser.add_argument("--capabilities", metavar="INDEX",
+                        help="Report BuildRequires that nothing in INDEX provides "
+                             "(see `rust2rpm capabilities`)")
+    parser.add_argument("-b", "--batch", metavar="FILE",
+                        help="Generate spec files for every crate[@version] listed in FILE (- for stdin)")
+    parser.add_argument("-r", "--recursive", action="store_true",
+                        help="Generate spec files for the crate and all its dependencies, in build order")
+    parser.add_argument("-j", "--jobs", type=int, default=DEFAULT_JOBS,
+                        help="Number of parallel downloads in batch and recursive mode")
+    parser.add_argument("--index", metavar="SOURCE", default=INDEX_URL,
+                        help="Sparse index URL or local crates.io-index mirror used to look up "
+                             "versions (empty to ask the crates.io API)")
+    parser.add_argument("--api-url", metavar="URL", default=os.getenv(API_URL_ENV, API_URL),
+                        help="crates.io compatible API used for downloads "
+                             "(default: ${} or {})".format(API_URL_ENV, API_URL))
+    parser.add_argument("--offline", action="store_true",
+                        help="Only use cached index data for version lookups")
+    add_feature_arguments(parser)
+    timing.add_arguments(parser)
+    parser.add_argument("crate", nargs="?", help="crates.io name")
+    parser.add_argument("version", nargs="?",
+                        help="crates.io version, or a requirement such as ^1.2 to pick the newest match")
+    args = parser.parse_args()
+
+    if args.batch is not None:
+        if args.crate is not None or args.patch or args.recursive:
+            parser.error("--batch can't be combined with a crate, --patch or --recursive")
+    elif args.crate is None:
+        parser.error("the following arguments are required: crate")
+    if args.recursive and args.patch:
+        parser.error("--recursive can't be combined with --patch")
+
+    timing.instrumented(args, generate, args)
+
+def generate(args):
+    if args.target is None:
+        args.target = get_default_target()
+
+    changelog_template = None
+    with timing.TIMINGS.phase("template"):
+        template = get_jinja_env().get_template("main.spec")
+        if args.update:
+            changelog_template = get_jinja_env().get_template(
+                "{}-update-changelog.spec.inc".format(args.target))
+    target_kwargs = get_target_kwargs(args.target)
+    target_kwargs["arch_conditional"] = args.arch_conditional
+    capabilities = None
+    if args.capabilities is not None:
+        capabilities = Capabilities.load(args.capabilities)
+
+    if args.batch is not None:
+        batch(args, template, target_kwargs, changelog_template, capabilities)
+        return
+    if args.recursive:
+        recursive(args, template, target_kwargs, changelog_template, capabilities)
+        return
+
+    editor = None
+    if args.patch:
+        editor = detect_editor()
+
+    cratef, crate, version = fetch_crate(args.crate, args.version, make_downloader(args))
+
+    diff = None
+    if args.patch or args.no_cache:
+        manifest, diff = read_crate(cratef, crate, version, editor)
+        metadata = Metadata.from_json(manifest, **feature_kwargs(args))
+    else:
+        metadata = load_metadata(cratef, crate, version, MetadataCache(), **feature_kwargs(args))
+
+    if args.patch:
+        patch_file = "{}-{}-fix-metadata.diff".format(crate, version) if diff else None
+    else:
+        patch_file, diff = foreign_targets_patch(cratef, crate, version)
+
+    spec_contents = render_spec(template, metadata, target_kwargs, patch_file)
+    changelog = None
+    if changelog_template is not None:
+        changelog = make_changelog(changelog_template, metadata, target_kwargs)
+    write_spec(crate, spec_contents, stdout=args.stdout, patch_file=patch_file, diff=diff,
+               changelog=changelog)
+    if capabilities is not None:
+        report_unsatisfied(crate, metadata, capabilities)
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,148 @@
+import hashlib
+import json
+import os
+import sys
+import tempfile
+
+from .metadata import Metadata, load_manifest, manifest_files
+from .timing import timed
+
+XDG_CACHE_HOME = os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+CACHEDIR = os.path.join(XDG_CACHE_HOME, "rust2rpm")
+
+# Bump whenever the stored manifest JSON or its interpretation changes
+CACHE_VERSION = 1
+DEFAULT_MAX_SIZE = 32 * 1024 * 1024
+# Running total of the entry sizes, so storing an entry doesn't have to
+# stat the whole cache
+SIZE_FILE = "size"
+# Directories already warned about being unusable
+_unusable = set()
+
+def file_digest(path, initial=b""):
+    h = hashlib.sha256(initial)
+    with open(path, "rb") as fobj:
+        for chunk in iter(lambda: fobj.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def update_size(path, entries, delta=0, total=None):
+    # Adds delta to (or sets) the total size recorded in the file at path and
+    # returns it; without a record, the sizes of entries() are counted once
+    import fcntl
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a+") as fobj:
+        fcntl.flock(fobj.fileno(), fcntl.LOCK_EX)
+        if total is None:
+            fobj.seek(0)
+            try:
+                total = int(fobj.read()) + delta
+            except ValueError:
+                total = sum(size for _, size, _ in entries())
+        fobj.seek(0)
+        fobj.truncate()
+        fobj.write(str(max(total, 0)))
+    return total
+
+def crate_key(path):
+    return file_digest(path)
+
+def manifest_key(path):
+    # Targets are inferred from the files next to Cargo.toml
+    root = os.path.dirname(os.path.abspath(path))
+    files = "\0".join(sorted(manifest_files(root)))
+    return file_digest(path, initial=files.encode("utf-8") + b"\0")
+
+class MetadataCache(object):
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory or os.path.join(CACHEDIR, "metadata")
+        self.max_size = max_size
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], "{}-v{}.json".format(key, CACHE_VERSION))
+
+    @timed("cache")
+    def get(self, key, **kwargs):
+        path = self._path(key)
+        try:
+            with open(path, "r") as fobj:
+                manifest = json.load(fobj)
+        except (OSError, ValueError):
+            return None
+        try:
+            # mtime is the LRU clock
+            os.utime(path)
+        except OSError:
+            pass
+        return Metadata.from_json(manifest, **kwargs)
+
+    def put(self, key, manifest, **kwargs):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as fobj:
+                json.dump(manifest, fobj)
+            try:
+                replaced = os.path.getsize(path)
+            except OSError:
+                replaced = 0
+            size = os.path.getsize(tmppath)
+            os.replace(tmppath, path)
+        except BaseException:
+            os.unlink(tmppath)
+            raise
+        if self._update_size(size - replaced) > self.max_size:
+            self.evict(keep=path)
+        return Metadata.from_json(manifest, **kwargs)
+
+    def _update_size(self, delta=0, total=None):
+        return update_size(os.path.join(self.directory, SIZE_FILE), self.entries, delta, total)
+
+    def entries(self):
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.endswith(".json"):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield st.st_mtime, st.st_size, path
+
+    def evict(self, keep=None):
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+        self._update_size(total=total)
+
+    # The manifest is stored as read, so any feature selection (kwargs of
+    # Metadata.from_json) can be applied to an entry
+    def load(self, key, loader, **kwargs):
+        # The cache is only an optimization: when it can't be written to,
+        # the manifest is used as read
+        md = self.get(key, **kwargs)
+        if md is not None:
+            return md
+        manifest = loader()
+        try:
+            return self.put(key, manifest, **kwargs)
+        except OSError as e:
+            if self.directory not in _unusable:
+                _unusable.add(self.directory)
+                print("warning: not caching metadata in {}: {}".format(self.directory, e),
+                      file=sys.stderr)
+            return Metadata.from_json(manifest, **kwargs)
+
+    def from_file(self, path, use_cargo=None, **kwargs):
+        return self.load(manifest_key(path), lambda: load_manifest(path, use_cargo), **kwargs)
@@ -0,0 +1,176 @@
+import argparse
+import gzip
+import json
+import os
+import re
+import sys
+import tempfile
+
+from . import timing
+from .cache import CACHEDIR, MetadataCache
+from .metadata import VersionIndex, version_key
+
+# The crate(...) capabilities some repositories provide, by crate name (or
+# name/feature), with the sorted list of versions providing each. On disk
+# it's gzipped JSON; the version lists dominate and compress well.
+DEFAULT_INDEX = os.path.join(CACHEDIR, "capabilities.json.gz")
+INDEX_FORMAT = 1
+RPM_NS = "{http://linux.duke.edu/metadata/rpm}"
+PROVIDE = re.compile(r"^crate\((?P<name>[^)\s]+)\)\s*=\s*(?:\d+:)?(?P<version>[^\s-]+)(?:-\S+)?$")
+
+def _open(path, mode="rb"):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode)
+    if path.endswith(".xz"):
+        import lzma
+        return lzma.open(path, mode)
+    return open(path, mode)
+
+def rpm_version(version):
+    # RPM sorts pre-releases with ~ where semver uses -
+    return version.replace("~", "-", 1)
+
+class Capabilities(object):
+    def __init__(self, crates=None):
+        self.crates = {}
+        self._indexes = {}
+        for name, versions in (crates or {}).items():
+            for version in versions:
+                self.add(name, version)
+
+    def __len__(self):
+        return len(self.crates)
+
+    def add(self, name, version):
+        try:
+            version_key(version)
+        except ValueError:
+            return False
+        self.crates.setdefault(name, set()).add(version)
+        self._indexes.pop(name, None)
+        return True
+
+    def add_provide(self, provide):
+        # "crate(foo/std) = 1.2.3"; anything else is ignored
+        match = PROVIDE.match(provide.strip())
+        if match is None:
+            return False
+        return self.add(match.group("name"), rpm_version(match.group("version")))
+
+    def add_primary(self, path):
+        # rpm-md primary.xml, plain or compressed
+        import xml.etree.ElementTree as ET
+        with _open(path) as fobj:
+            for _, elem in ET.iterparse(fobj):
+                if elem.tag == RPM_NS + "entry":
+                    name = elem.get("name", "")
+                    if name.startswith("crate(") and elem.get("flags") == "EQ" and elem.get("ver"):
+                        self.add(name[6:-1], rpm_version(elem.get("ver")))
+                elif elem.tag.endswith("}package"):
+                    elem.clear()
+
+    def add_provides(self, path):
+        # A JSON list of provides, or one provide per line (as printed by
+        # `dnf repoquery --provides`)
+        with _open(path) as fobj:
+            contents = fobj.read().decode("utf-8")
+        try:
+            provides = json.loads(contents)
+        except ValueError:
+            provides = contents.splitlines()
+        for provide in provides:
+            self.add_provide(provide)
+
+    def add_registry(self, directory, cache=None):
+        # Crates unpacked in a %cargo_registry tree
+        cache = cache or MetadataCache()
+        for entry in sorted(os.listdir(directory)):
+            toml = os.path.join(directory, entry, "Cargo.toml")
+            if not os.path.isfile(toml):
+                continue
+            try:
+                md = cache.from_file(toml)
+            except Exception as e:
+                print("warning: skipping {}: {}".format(toml, e), file=sys.stderr)
+                continue
+            for provide in md.provides:
+                self.add_provide(provide)
+
+    def _index(self, name):
+        index = self._indexes.get(name)
+        if index is None and name in self.crates:
+            index = self._indexes[name] = VersionIndex(self.crates[name])
+        return index
+
+    def satisfies(self, dep):
+        # Whether one provided version matches dep, with all its features
+        index = self._index(dep.name)
+        if index is None:
+            return False
+        candidates = index.matching(dep.spec)
+        for feature in dep.features:
+            provided = self.crates.get("{}/{}".format(dep.name, feature), ())
+            candidates = [version for version in candidates if version in provided]
+        return len(candidates) > 0
+
+    def unsatisfied(self, deps):
+        return [dep for dep in deps if not self.satisfies(dep)]
+
+    @classmethod
+    @timing.timed("capabilities")
+    def load(cls, path):
+        with gzip.open(path, "rt") as fobj:
+            data = json.load(fobj)
+        if data.get("format") != INDEX_FORMAT:
+            raise ValueError("{}: unsupported capability index format".format(path))
+        self = cls()
+        self.crates = dict((name, set(versions)) for name, versions in data["crates"].items())
+        return self
+
+    def save(self, path):
+        crates = dict((name, sorted(versions, key=version_key))
+                      for name, versions in self.crates.items())
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmppath = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with gzip.open(os.fdopen(fd, "wb"), "wt") as fobj:
+                json.dump({"format": INDEX_FORMAT, "crates": crates}, fobj,
+                          sort_keys=True, separators=(",", ":"))
+            os.replace(tmppath, path)
+        except BaseException:
+            os.unlink(tmppath)
+            raise
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog="rust2rpm capabilities",
+                                     description="Build the index of crate(...) provides used "
+                                                 "by `rust2rpm --capabilities`")
+    parser.add_argument("-o", "--output", default=DEFAULT_INDEX,
+                        help="Index file to write (default: {})".format(DEFAULT_INDEX))
+    parser.add_argument("--primary", metavar="FILE", action="append", default=[],
+                        help="Add the provides of a repository's primary.xml(.gz|.xz)")
+    parser.add_argument("--provides", metavar="FILE", action="append", default=[],
+                        help="Add provides listed in FILE, as JSON list or one per line")
+    parser.add_argument("--registry", metavar="DIR", action="append", default=[],
+                        help="Add the crates unpacked in DIR, e.g. %%{cargo_registry}")
+    timing.add_arguments(parser)
+    return parser
+
+def run(args):
+    capabilities = Capabilities()
+    for path in args.primary:
+        capabilities.add_primary(path)
+    for path in args.provides:
+        capabilities.add_provides(path)
+    for directory in args.registry:
+        capabilities.add_registry(directory)
+    capabilities.save(args.output)
+    print("Indexed {} capabilities in {}".format(len(capabilities), args.output), file=sys.stderr)
+
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    if not (args.primary or args.provides or args.registry):
+        parser.error("nothing to index, use --primary, --provides or --registry")
+    timing.instrumented(args, run, args)
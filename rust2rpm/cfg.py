@@ -0,0 +1,128 @@
+import functools
+import re
+
+# Keep in sync with %rust_arches in data/macros.rust-srpm
+RUST_ARCHES = ("x86_64", "i686", "armv7hl", "aarch64", "ppc64", "ppc64le", "s390x")
+
+def _linux(triple, arch, width, endian, env="gnu", features=()):
+    return {
+        "triple": triple,
+        "target_arch": {arch},
+        "target_os": {"linux"},
+        "target_family": {"unix"},
+        "target_env": {env},
+        "target_vendor": {"unknown"},
+        "target_endian": {endian},
+        "target_pointer_width": {width},
+        "target_has_atomic": {"8", "16", "32", "64", "ptr"},
+        "target_feature": set(features),
+        "unix": True,
+    }
+
+# What rustc reports (`rustc --print cfg`) for each arch's default target
+TARGET_CFGS = {
+    "x86_64": _linux("x86_64-unknown-linux-gnu", "x86_64", "64", "little",
+                     features=("fxsr", "sse", "sse2")),
+    "i686": _linux("i686-unknown-linux-gnu", "x86", "32", "little",
+                   features=("fxsr", "sse", "sse2")),
+    "armv7hl": _linux("armv7-unknown-linux-gnueabihf", "arm", "32", "little",
+                      features=("aclass", "dsp", "v5te", "v6", "v7", "vfp2", "vfp3", "thumb2")),
+    "aarch64": _linux("aarch64-unknown-linux-gnu", "aarch64", "64", "little",
+                      features=("neon",)),
+    "ppc64": _linux("powerpc64-unknown-linux-gnu", "powerpc64", "64", "big"),
+    "ppc64le": _linux("powerpc64le-unknown-linux-gnu", "powerpc64", "64", "little"),
+    "s390x": _linux("s390x-unknown-linux-gnu", "s390x", "64", "big"),
+}
+
+_TOKEN = re.compile(r'\s*(?:(?P<ident>[A-Za-z_][A-Za-z0-9_]*)|"(?P<string>[^"]*)"|(?P<punct>[(),=]))')
+
+def _tokenize(expr):
+    tokens = []
+    pos = 0
+    expr = expr.rstrip()
+    while pos < len(expr):
+        match = _TOKEN.match(expr, pos)
+        if match is None:
+            raise ValueError("Invalid cfg expression: {!r}".format(expr))
+        pos = match.end()
+        for kind in ("ident", "string", "punct"):
+            if match.group(kind) is not None:
+                tokens.append((kind, match.group(kind)))
+    return tokens
+
+# Predicates are nested tuples:
+#   ("all", [...]), ("any", [...]), ("not", pred), ("key", name, value or None)
+def parse_cfg(expr):
+    tokens = _tokenize(expr)
+    pos = [0]
+
+    def next_token(expected=None):
+        if pos[0] >= len(tokens):
+            raise ValueError("Unexpected end of cfg expression: {!r}".format(expr))
+        token = tokens[pos[0]]
+        if expected is not None and token[1] != expected:
+            raise ValueError("Expected {!r} in cfg expression: {!r}".format(expected, expr))
+        pos[0] += 1
+        return token
+
+    def peek():
+        return tokens[pos[0]][1] if pos[0] < len(tokens) else None
+
+    def predicate():
+        kind, name = next_token()
+        if kind != "ident":
+            raise ValueError("Expected identifier in cfg expression: {!r}".format(expr))
+        if name in ("all", "any", "not") and peek() == "(":
+            next_token("(")
+            preds = []
+            while peek() != ")":
+                preds.append(predicate())
+                if peek() != ")":
+                    next_token(",")
+            next_token(")")
+            if name == "not":
+                if len(preds) != 1:
+                    raise ValueError("not() takes one predicate: {!r}".format(expr))
+                return ("not", preds[0])
+            return (name, preds)
+        if peek() == "=":
+            next_token("=")
+            kind, value = next_token()
+            if kind != "string":
+                raise ValueError("Expected string in cfg expression: {!r}".format(expr))
+            return ("key", name, value)
+        return ("key", name, None)
+
+    if not tokens or tokens[0] != ("ident", "cfg"):
+        raise ValueError("Not a cfg expression: {!r}".format(expr))
+    pos[0] = 1
+    next_token("(")
+    pred = predicate()
+    next_token(")")
+    if pos[0] != len(tokens):
+        raise ValueError("Trailing tokens in cfg expression: {!r}".format(expr))
+    return pred
+
+def evaluate(pred, cfg):
+    if pred[0] == "all":
+        return all(evaluate(p, cfg) for p in pred[1])
+    if pred[0] == "any":
+        return any(evaluate(p, cfg) for p in pred[1])
+    if pred[0] == "not":
+        return not evaluate(pred[1], cfg)
+    _, name, value = pred
+    if value is None:
+        return cfg.get(name) is True
+    values = cfg.get(name)
+    return isinstance(values, set) and value in values
+
+@functools.lru_cache(maxsize=1024)
+def target_arches(target, arches=RUST_ARCHES):
+    # Arches (out of arches) a [target.<target>] table applies to; target is
+    # either a cfg() expression or a target triple.
+    if target is None:
+        return tuple(arches)
+    if target.startswith("cfg("):
+        pred = parse_cfg(target)
+        return tuple(arch for arch in arches if evaluate(pred, TARGET_CFGS[arch]))
+    return tuple(arch for arch in arches if TARGET_CFGS[arch]["triple"] == target)
@@ -1,48 +1,202 @@
 import argparse
+import collections
+import functools
+import glob
 import itertools
+import json
+import os
+import shlex
 import sys
 
-from . import Metadata
-
-def main():
-    parser = argparse.ArgumentParser()
-    group = parser.add_mutually_exclusive_group(required=True)
-    group.add_argument("-n", "--name", action="store_true", help="Print name")
-    group.add_argument("-v", "--version", action="store_true", help="Print version")
-    group.add_argument("-t", "--target-kinds", action="store_true", help="Print target kinds")
-    group.add_argument("-P", "--provides", action="store_true", help="Print Provides")
-    group.add_argument("-R", "--requires", action="store_true", help="Print Requires")
-    group.add_argument("-BR", "--build-requires", action="store_true", help="Print BuildRequires")
-    group.add_argument("-TR", "--test-requires", action="store_true", help="Print TestRequires")
+from . import Metadata, timing
+from .cache import MetadataCache
+from .inspector_client import SOCKET_ENV, default_socket
+from .metadata import add_feature_arguments, feature_kwargs
+
+CARGO_REGISTRY = "/usr/share/cargo/registry"
+QUERIES = ("name", "version", "target_kinds", "provides",
+           "requires", "build_requires", "test_requires", "optional_requires")
+
+def get_parser(parser=None):
+    if parser is None:
+        parser = argparse.ArgumentParser()
+    queries = parser.add_argument_group("queries")
+    queries.add_argument("-n", "--name", action="store_true", help="Print name")
+    queries.add_argument("-v", "--version", action="store_true", help="Print version")
+    queries.add_argument("-t", "--target-kinds", action="store_true", help="Print target kinds")
+    queries.add_argument("-P", "--provides", action="store_true", help="Print Provides")
+    queries.add_argument("-R", "--requires", action="store_true", help="Print Requires")
+    queries.add_argument("-BR", "--build-requires", action="store_true",
+                         help="Print BuildRequires for the feature selection")
+    queries.add_argument("-TR", "--test-requires", action="store_true", help="Print TestRequires")
+    queries.add_argument("-OR", "--optional-requires", action="store_true",
+                         help="Print requirements only needed by features not selected")
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument("--json", action="store_true",
+                        help="Answer all queries at once as one JSON object per manifest")
+    output.add_argument("--shell", action="store_true",
+                        help="Answer all queries at once as CRATE_* shell variable assignments")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--registry", nargs="?", metavar="DIR", const=CARGO_REGISTRY,
+                       help="Inspect every crate in a cargo registry directory and print "
+                            "one JSON record per crate")
+    group.add_argument("--server", nargs="?", metavar="SOCKET", const="",
+                       help="Answer queries from cargo-inspector-client on a unix socket "
+                            "(default: ${} or $XDG_RUNTIME_DIR/cargo-inspector.sock)".format(SOCKET_ENV))
+    parser.add_argument("--cargo", action="store_true",
+                        help="Read manifests with `cargo read-manifest` instead of the builtin parser")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Do not use the on-disk metadata cache")
+    parser.add_argument("-w", "--workspace", action="store_true",
+                        help="Treat each file as a workspace and answer for all of its members, "
+                             "dependencies first")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="Number of worker processes for --registry")
+    add_feature_arguments(parser)
+    timing.add_arguments(parser)
     parser.add_argument("file", nargs="*", help="Path(s) to Cargo.toml")
-    args = parser.parse_args()
+    return parser
 
-    files = args.file or sys.stdin.readlines()
+def parse_args(parser, argv=None):
+    args = parser.parse_args(argv)
+    queries = [query for query in QUERIES if getattr(args, query)]
+    if args.server is not None or args.registry is not None:
+        if queries:
+            parser.error("queries can't be combined with --server or --registry")
+        if args.server is not None and selects_features(args):
+            parser.error("features are selected per query with --server")
+        if args.server == "":
+            args.server = default_socket()
+            if args.server is None:
+                parser.error("--server needs a SOCKET when neither ${} nor $XDG_RUNTIME_DIR "
+                             "is set".format(SOCKET_ENV))
+    elif not queries:
+        parser.error("one of the query arguments is required")
+    elif len(queries) > 1 and not (args.json or args.shell):
+        parser.error("use --json or --shell to answer several queries at once")
+    return args
+
+def selects_features(args):
+    return bool(args.features or args.all_features or args.no_default_features)
+
+def query(md, name):
+    if name == "name":
+        return md.name
+    elif name == "version":
+        return md.version
+    elif name == "target_kinds":
+        return sorted(set(tgt.kind for tgt in md.targets))
+    else:
+        return [str(dep) for dep in getattr(md, name)]
+
+def print_structured(args, md, out):
+    answers = collections.OrderedDict((q, query(md, q)) for q in QUERIES if getattr(args, q))
+    if args.json:
+        print(json.dumps(answers), file=out)
+        return
+    for name, value in answers.items():
+        if name == "target_kinds":
+            value = " ".join(value)
+        elif isinstance(value, list):
+            value = "\n".join(value)
+        print("CRATE_{}={}".format(name.upper(), shlex.quote(value)), file=out)
+
+def get_loader(args):
+    if args.cargo:
+        return functools.partial(Metadata.from_file, use_cargo=True, **feature_kwargs(args))
+    if args.no_cache:
+        return functools.partial(Metadata.from_file, **feature_kwargs(args))
+    return functools.partial(MetadataCache().from_file, **feature_kwargs(args))
+
+def inspect(args, files, out=None, load=None):
+    out = out or sys.stdout
+    load = load or get_loader(args)
 
     def print_deps(deps):
         if len(deps) > 0:
-            print("\n".join(str(dep) for dep in deps))
+            print("\n".join(str(dep) for dep in deps), file=out)
 
     for f in files:
         f = f.rstrip()
-        md = Metadata.from_file(f)
-        if args.name:
-            print(md.name)
-        if args.version:
-            print(md.version)
-        if args.target_kinds:
-            print("\n".join(set(tgt.kind for tgt in md.targets)))
-        if args.provides:
-            print_deps(md.provides)
-        if args.requires or args.build_requires:
-            print_deps(list(itertools.chain(md.requires, md.build_requires)))
-        if args.test_requires:
-            print_deps(md.test_requires)
-        if args.requires:
-            # Someone should own /usr/share/cargo/registry
-            print("cargo")
-        if args.build_requires:
-            print("rust-packaging")
+        if args.workspace:
+            # Every member at once, from a single `cargo metadata` call
+            mds = Metadata.from_workspace(f, **feature_kwargs(args))
+        else:
+            mds = [load(f)]
+        for md in mds:
+            if args.json or args.shell:
+                print_structured(args, md, out)
+                continue
+            if args.name:
+                print(md.name, file=out)
+            if args.version:
+                print(md.version, file=out)
+            if args.target_kinds:
+                print("\n".join(set(tgt.kind for tgt in md.targets)), file=out)
+            if args.provides:
+                print_deps(md.provides)
+            if args.requires:
+                # Everything the devel package needs, whatever features
+                # the user builds
+                print_deps(list(itertools.chain(md.requires, md.build_requires)))
+            elif args.build_requires:
+                print_deps(list(itertools.chain(md.enabled_requires, md.enabled_build_requires)))
+            if args.test_requires:
+                print_deps(md.test_requires)
+            if args.optional_requires:
+                print_deps(md.optional_requires)
+            if args.requires:
+                # Someone should own /usr/share/cargo/registry
+                print("cargo", file=out)
+            if args.build_requires:
+                print("rust-packaging", file=out)
+
+def scan_manifest(job):
+    path, use_cargo, no_cache, kwargs = job
+    try:
+        if use_cargo:
+            md = Metadata.from_file(path, use_cargo=True, **kwargs)
+        elif no_cache:
+            md = Metadata.from_file(path, **kwargs)
+        else:
+            md = MetadataCache().from_file(path, **kwargs)
+    except Exception as e:
+        return {"path": path, "error": str(e)}
+    record = collections.OrderedDict(path=path)
+    for name in QUERIES:
+        if name != "target_kinds":
+            record[name] = query(md, name)
+    return record
+
+def scan_registry(args, out=None):
+    import multiprocessing
+    out = out or sys.stdout
+    paths = sorted(glob.glob(os.path.join(glob.escape(args.registry), "*", "Cargo.toml")))
+    jobs = [(path, args.cargo, args.no_cache, feature_kwargs(args)) for path in paths]
+    failed = 0
+    with multiprocessing.Pool(args.jobs) as pool:
+        for record in pool.imap(scan_manifest, jobs, chunksize=16):
+            failed += "error" in record
+            print(json.dumps(record), file=out)
+    return failed
+
+def run(args):
+    if args.server is not None:
+        from .server import serve
+        serve(args.server, get_loader(args))
+        return 0
+    if args.registry is not None:
+        return 1 if scan_registry(args) > 0 else 0
+
+    files = args.file or sys.stdin.readlines()
+    inspect(args, files)
+    return 0
+
+def main(argv=None):
+    parser = get_parser()
+    args = parse_args(parser, argv)
+    if timing.instrumented(args, run, args) != 0:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
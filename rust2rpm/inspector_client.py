@@ -0,0 +1,81 @@
+import json
+import os
+import socket
+import struct
+import sys
+import time
+
+# Keep this module free of heavy imports: it runs once per Cargo.toml from
+# rpm's dependency generator and only forwards the query to a running
+# `cargo-inspector --server`.
+SOCKET_ENV = "CARGO_INSPECTOR_SOCKET"
+# Seconds to wait for a server before answering in-process
+TIMEOUT = 10
+
+def default_socket():
+    # Only places other users can't take over: a shared directory like /tmp
+    # would let anyone answer with their own Requires and Provides.
+    # None when there is no such place.
+    path = os.getenv(SOCKET_ENV)
+    if path:
+        return path
+    rundir = os.getenv("XDG_RUNTIME_DIR")
+    if rundir:
+        return os.path.join(rundir, "cargo-inspector.sock")
+    return None
+
+def _check_owner(sock, path):
+    if os.stat(path).st_uid != os.getuid():
+        raise PermissionError("{} is not owned by the current user".format(path))
+    if hasattr(socket, "SO_PEERCRED"):
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+        if struct.unpack("3i", creds)[1] != os.getuid():
+            raise PermissionError("{} is served by another user".format(path))
+
+def _connect(sock, path, deadline):
+    # With a timeout, a unix socket with a full backlog fails with EAGAIN
+    # instead of waiting for the server to accept
+    while True:
+        try:
+            sock.connect(path)
+            return
+        except BlockingIOError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.01)
+
+def query(path, argv, stdin="", timeout=TIMEOUT):
+    request = {"argv": argv, "cwd": os.getcwd(), "stdin": stdin}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        _connect(sock, path, time.monotonic() + timeout)
+        _check_owner(sock, path)
+        sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        with sock.makefile("rb") as fobj:
+            return json.loads(fobj.readline().decode("utf-8"))
+
+def main():
+    argv = sys.argv[1:]
+    stdin = ""
+    if all(arg.startswith("-") for arg in argv):
+        stdin = sys.stdin.read()
+
+    path = default_socket()
+    try:
+        if path is None:
+            raise FileNotFoundError(SOCKET_ENV)
+        response = query(path, argv, stdin)
+    except (OSError, ValueError):
+        # No (trustworthy) server around, answer the query ourselves
+        from . import inspector
+        if stdin:
+            argv = argv + stdin.splitlines()
+        inspector.main(argv)
+        return
+
+    sys.stdout.write(response["stdout"])
+    sys.stderr.write(response["stderr"])
+    sys.exit(response["status"])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+from . import timing
+
+# FICLONE from linux/fs.h
+FICLONE = 0x40049409
+LINK_MODES = ("auto", "reflink", "hardlink", "copy")
+# `cargo package -l` lists these even when it would only generate them
+GENERATED_FILES = ("Cargo.lock", "Cargo.toml.orig", ".cargo_vcs_info.json")
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as fobj:
+        if os.fstat(fobj.fileno()).st_size > 0:
+            import mmap
+            with mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                h.update(data)
+    return h.hexdigest()
+
+def reflink(src, dst):
+    import fcntl
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.unlink(dst)
+            raise
+    shutil.copystat(src, dst)
+
+def install_file(src, dst, mode="auto"):
+    # Returns how the file ended up in place
+    if mode in ("auto", "reflink"):
+        try:
+            reflink(src, dst)
+            return "reflink"
+        except OSError:
+            if mode == "reflink":
+                raise
+    if mode in ("auto", "hardlink"):
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError:
+            if mode == "hardlink":
+                raise
+    shutil.copy2(src, dst)
+    return "copy"
+
+def package_files(srcdir):
+    output = subprocess.check_output(["cargo", "package", "-l"], cwd=srcdir,
+                                     universal_newlines=True)
+    return [line for line in output.splitlines()
+            if line and (line not in GENERATED_FILES or os.path.exists(os.path.join(srcdir, line)))]
+
+def install(srcdir, destdir, files, manifest=None, mode="auto", jobs=None, crate=None):
+    # Copies files (relative to srcdir) into destdir, optionally taking
+    # Cargo.toml from manifest, and writes .cargo-checksum.json for them.
+    sources = dict((f, os.path.join(srcdir, f)) for f in files)
+    if manifest is not None:
+        sources["Cargo.toml"] = manifest
+
+    with timing.TIMINGS.phase("copy"):
+        for directory in sorted(set(os.path.dirname(f) for f in sources)):
+            os.makedirs(os.path.join(destdir, directory), exist_ok=True)
+
+        def copy(item):
+            name, src = item
+            dst = os.path.join(destdir, name)
+            if os.path.lexists(dst):
+                os.unlink(dst)
+            return install_file(src, dst, mode)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            methods = list(executor.map(copy, sorted(sources.items())))
+
+    with timing.TIMINGS.phase("checksum"):
+        names = sorted(sources)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            digests = executor.map(file_sha256, [os.path.join(destdir, name) for name in names])
+            checksums = {"files": dict(zip(names, digests)),
+                         "package": file_sha256(crate) if crate is not None else ""}
+        timing.TIMINGS.add_bytes("checksum", sum(os.path.getsize(os.path.join(destdir, name))
+                                                 for name in names))
+
+    with open(os.path.join(destdir, ".cargo-checksum.json"), "w") as fobj:
+        json.dump(checksums, fobj, sort_keys=True)
+    return dict((method, methods.count(method)) for method in set(methods))
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog="rust2rpm install")
+    parser.add_argument("-C", "--directory", default=".",
+                        help="Crate source directory (default: current directory)")
+    parser.add_argument("--files", metavar="FILE",
+                        help="File list to install, one path per line (- for stdin; "
+                             "default: `cargo package -l`)")
+    parser.add_argument("--manifest", metavar="FILE",
+                        help="Install FILE as Cargo.toml")
+    parser.add_argument("--crate", metavar="FILE",
+                        help="Record the checksum of this .crate file as package checksum")
+    parser.add_argument("--link", choices=LINK_MODES, default="auto",
+                        help="How to place files: reflink, then hardlink, then copy (default: auto)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="Number of parallel copy and checksum workers")
+    timing.add_arguments(parser)
+    parser.add_argument("destdir", help="Registry directory of the crate")
+    return parser
+
+def run(args):
+    if args.files == "-":
+        files = [line.rstrip("\n") for line in sys.stdin if line.strip()]
+    elif args.files is not None:
+        with open(args.files, "r") as fobj:
+            files = [line.rstrip("\n") for line in fobj if line.strip()]
+    else:
+        files = package_files(args.directory)
+    install(args.directory, args.destdir, files, manifest=args.manifest,
+            mode=args.link, jobs=args.jobs, crate=args.crate)
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    timing.instrumented(args, run, args)
@@ -1,39 +1,104 @@
 __all__ = ["Dependency", "Metadata"]
 
+import bisect
+import collections
+import functools
 import itertools
 import json
-import subprocess
+import os
+import re
 import sys
 
 import semantic_version as semver
 
-class Target(object):
-    def __init__(self, kind, name):
-        self.kind = kind
-        self.name = name
+from .cfg import RUST_ARCHES, target_arches
+from .timing import TIMINGS, timed
+
+try:
+    from tomllib import loads as toml_loads
+except ImportError:
+    try:
+        from toml import loads as toml_loads
+    except ImportError:
+        toml_loads = None
+
+class UnsupportedManifest(Exception):
+    pass
+
+# Metadata, Dependency and Target are immutable and use __slots__: a registry
+# scan keeps hundreds of thousands of them around.
+class Target(collections.namedtuple("Target", ["kind", "name"])):
+    __slots__ = ()
 
     def __repr__(self):
         return "<Target {self.kind}|{self.name}>".format(self=self)
 
-class Dependency(object):
-    def __init__(self, name, req, features=(), provides=False):
-        self.name = name
-        self.spec = self._parse_req(req)
-        self.features = features
-        self.provides = provides
-        if self.provides:
-            if len(self.spec.specs) > 1 or \
-               (len(self.spec.specs) == 1 and self.spec.specs[0].kind != self.spec.specs[0].KIND_EQUAL):
-                raise Exception("Provides can't be applied to ranged version, {!r}".format(self.spec))
+class Immutable(object):
+    __slots__ = ()
+
+    def _set(self, **attrs):
+        for name, value in attrs.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("{} is immutable".format(type(self).__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError("{} is immutable".format(type(self).__name__))
+
+# Parsed requirements and rendered dependency strings are shared between all
+# Dependency instances; the same few requirement strings recur all over a
+# registry.
+REQ_CACHE_SIZE = 4096
+RENDER_CACHE_SIZE = 16384
+
+class Dependency(Immutable):
+    # arches is None when needed on every arch
+    __slots__ = ("name", "req", "features", "provides", "arches")
+
+    def __init__(self, name, req, features=(), provides=False, arches=None):
+        setattr = object.__setattr__
+        setattr(self, "name", name)
+        setattr(self, "req", req)
+        setattr(self, "features", tuple(features))
+        setattr(self, "provides", provides)
+        setattr(self, "arches", arches)
+        if provides:
+            spec = self.spec
+            if len(spec.specs) > 1 or \
+               (len(spec.specs) == 1 and spec.specs[0].kind != spec.specs[0].KIND_EQUAL):
+                raise Exception("Provides can't be applied to ranged version, {!r}".format(spec))
+
+    @property
+    def spec(self):
+        # Parsed on first use, shared through the parse cache
+        return self._parse_req(self.req)
 
     def __repr__(self):
+        return self._render(self.name, self.req, self.features, self.provides)
+
+    @staticmethod
+    def cache_info():
+        return {"parse": Dependency._parse_req.cache_info(),
+                "render": Dependency._render.cache_info()}
+
+    @staticmethod
+    def cache_clear():
+        Dependency._parse_req.cache_clear()
+        Dependency._render.cache_clear()
+        _merge_reqs.cache_clear()
+
+    @staticmethod
+    @functools.lru_cache(maxsize=RENDER_CACHE_SIZE)
+    def _render(name, req, features, provides):
         def req_to_str(name, spec=None, feature=None):
             f_part = "/{}".format(feature) if feature is not None else ""
             basestr = "crate({}{})".format(name, f_part)
             if spec is not None:
-                if spec.kind == spec.KIND_EQUAL:
-                    spec.kind = spec.KIND_SHORTEQ
-                if spec.kind == spec.KIND_ANY:
+                kind = spec.kind
+                if kind == spec.KIND_EQUAL:
+                    kind = spec.KIND_SHORTEQ
+                if kind == spec.KIND_ANY:
                     if spec.spec == "":
                         # Just wildcard
                         return basestr
@@ -41,19 +106,20 @@ class Dependency(object):
                         # Wildcard in string
                         assert False, spec.spec
                 version = str(spec.spec).replace('-', '~')
-                return "{} {} {}".format(basestr, spec.kind, version)
+                return "{} {} {}".format(basestr, kind, version)
             else:
                 return basestr
 
-        if self.provides:
-            spec = self.spec.specs[0]
-            provs = [req_to_str(self.name, spec)]
-            for feature in self.features:
-                provs.append(req_to_str(self.name, spec, feature))
+        specs = Dependency._parse_req(req).specs
+        if provides:
+            spec = specs[0]
+            provs = [req_to_str(name, spec)]
+            for feature in features:
+                provs.append(req_to_str(name, spec, feature))
             return " and ".join(provs)
 
-        reqs = [req_to_str(self.name, spec=req) for req in self.spec.specs]
-        features = [req_to_str(self.name, feature=feature) for feature in self.features]
+        reqs = [req_to_str(name, spec=req) for req in specs]
+        features = [req_to_str(name, feature=feature) for feature in features]
 
         use_rich = False
         if len(reqs) > 1:
@@ -82,6 +148,7 @@ class Dependency(object):
             return reqstr
 
     @staticmethod
+    @functools.lru_cache(maxsize=REQ_CACHE_SIZE)
     def _parse_req(s):
         if "*" in s and s != "*":
             # XXX: https://github.com/rbarrois/python-semanticversion/issues/51
@@ -134,60 +201,735 @@ class Dependency(object):
                 assert False, req.kind
         return semver.Spec(",".join(parsed))
 
-class Metadata(object):
-    def __init__(self):
-        self.name = None
-        self.license = None
-        self.license_file = None
-        self.description = None
-        self.version = None
-        self._targets = []
-        self.provides = []
-        self.requires = []
-        self.build_requires = []
-        self.test_requires = []
+_VERSION = re.compile(r"^(\d+)\.(\d+)\.(\d+)(?:-([0-9A-Za-z.-]+))?(?:\+[0-9A-Za-z.-]+)?$")
 
-    @classmethod
-    def from_json(cls, metadata):
-        self = cls()
+def _prerelease_key(prerelease):
+    # Numeric identifiers sort before alphanumeric ones, a prefix first
+    return tuple((0, int(part), "") if part.isdigit() else (1, 0, part) for part in prerelease)
 
-        md = metadata
-        self.name = md["name"]
-        self.license = md["license"]
-        self.license_file = md["license_file"]
-        self.description = md.get("description")
-        self.version = md["version"]
-        version = "={}".format(self.version)
+def version_key(version):
+    # Sortable tuple in semver precedence order: (x, y, z, 1, pre-release)
+    # for pre-releases, (x, y, z, 2, ()) for releases. Build metadata is
+    # ignored.
+    if isinstance(version, str):
+        match = _VERSION.match(version)
+        if match is None:
+            version = semver.Version(version)
+        else:
+            major, minor, patch, pre = match.groups()
+            if pre:
+                return (int(major), int(minor), int(patch), 1, _prerelease_key(pre.split(".")))
+            return (int(major), int(minor), int(patch), 2, ())
+    if version.prerelease:
+        return (version.major, version.minor, version.patch, 1, _prerelease_key(version.prerelease))
+    return (version.major, version.minor, version.patch, 2, ())
+
+def _bounds(item):
+    # The (lower, upper) bounds of a parsed SpecItem as version_key()
+    # positions. Its version is partial: without a pre-release part,
+    # pre-releases of that version compare equal to it, so "< 2.0.0"
+    # excludes 2.0.0-alpha and ">= 1.0.0" includes 1.0.0-alpha;
+    # (x, y, z, 0, ()) sorts before any version of x.y.z. Lower bounds are
+    # (position, strict), upper ones (position, inclusive); None is unbounded.
+    if item.kind == item.KIND_ANY:
+        return None, None
+    v = item.spec
+    if v.prerelease:
+        pos = version_key(v)
+    else:
+        first = (v.major, v.minor, v.patch, 0, ())
+        after = (v.major, v.minor, v.patch + 1, 0, ())
+    if item.kind == item.KIND_GTE:
+        return ((pos, False) if v.prerelease else (first, False)), None
+    elif item.kind == item.KIND_GT:
+        return ((pos, True) if v.prerelease else (after, False)), None
+    elif item.kind == item.KIND_LT:
+        return None, ((pos, False) if v.prerelease else (first, False))
+    elif item.kind == item.KIND_LTE:
+        return None, ((pos, True) if v.prerelease else (after, False))
+    elif item.kind == item.KIND_EQUAL:
+        if v.prerelease:
+            return (pos, False), (pos, True)
+        return (first, False), (after, False)
+    raise ValueError("Can't merge {!r}".format(item))
+
+# ">= 0.0.0" holds for every version
+UNBOUNDED = ((0, 0, 0, 0, ()), False)
+
+def _merge_specs(items):
+    # Intersects a conjunction of parsed SpecItems, keeping only the items
+    # for the tightest lower and upper bound. Returns None if no version
+    # can match.
+    lower = upper = None
+    for item in items:
+        try:
+            item_lower, item_upper = _bounds(item)
+        except ValueError:
+            return None
+        if item_lower is not None and (lower is None or item_lower > lower[0]):
+            lower = (item_lower, item)
+        if item_upper is not None and (upper is None or item_upper < upper[0]):
+            upper = (item_upper, item)
+    if lower is not None and upper is not None:
+        (lv, strict), (uv, inclusive) = lower[0], upper[0]
+        if lv > uv or (lv == uv and (strict or not inclusive)):
+            return None
+    kept = []
+    if lower is not None and lower[0] != UNBOUNDED:
+        kept.append(lower[1])
+    if upper is not None and (not kept or upper[1] is not kept[0]):
+        kept.append(upper[1])
+    return ["{}{}".format(item.kind, item.spec) for item in kept]
+
+@functools.lru_cache(maxsize=REQ_CACHE_SIZE)
+def _merge_reqs(reqs):
+    items = [item for req in reqs for item in Dependency._parse_req(req).specs]
+    specs = _merge_specs(items)
+    if specs is None:
+        return None
+    if len(reqs) == 1 and len(specs) == len(items):
+        # Already minimal
+        return reqs[0]
+    return ",".join(specs) or "*"
+
+def _merged(dep, reqs):
+    req = _merge_reqs(tuple(reqs))
+    if req is None:
+        return None
+    if req == dep.req:
+        return dep
+    return Dependency(dep.name, req, features=dep.features, arches=dep.arches)
+
+def merge_requirements(deps):
+    # Minimal list of requirements equivalent to deps: requirements on the
+    # same crate with the same features (and arches) are intersected into
+    # one, dropping bounds that are always satisfied. Requirements that
+    # can't be met at once are kept apart, cargo may use several semver
+    # incompatible versions of a crate. Most crates don't repeat any, those
+    # are returned as they are.
+    deps = list(deps)
+    keys = [(dep.name, frozenset(dep.features) if dep.features else (), dep.arches)
+            for dep in deps]
+    if len(set(keys)) == len(keys):
+        return deps
+    groups = collections.OrderedDict()
+    for key, dep in zip(keys, deps):
+        groups.setdefault(key, []).append(dep)
+    merged = []
+    for group in groups.values():
+        if len(group) == 1:
+            merged.append(group[0])
+            continue
+        dep = _merged(group[0], [dep.req for dep in group])
+        if dep is not None:
+            merged.append(dep)
+            continue
+        for dep in group:
+            merged.append(_merged(dep, [dep.req]) or dep)
+    return merged
+
+def _tighter(lower, upper, other_lower, other_upper):
+    if other_lower is not None and (lower is None or other_lower > lower):
+        lower = other_lower
+    if other_upper is not None and (upper is None or other_upper < upper):
+        upper = other_upper
+    return lower, upper
+
+def _bisect(keys, lower, upper):
+    # Index range of keys within the bounds
+    lo, hi = 0, len(keys)
+    if lower is not None:
+        lo = (bisect.bisect_right if lower[1] else bisect.bisect_left)(keys, lower[0])
+    if upper is not None:
+        hi = (bisect.bisect_right if upper[1] else bisect.bisect_left)(keys, upper[0])
+    return lo, max(lo, hi)
+
+class VersionIndex(object):
+    # Versions of one crate, sorted by version_key(), answering requirement
+    # queries by bisection. Like cargo, a requirement only matches
+    # pre-releases of an x.y.z it names with a pre-release itself.
+    def __init__(self, versions):
+        pairs = sorted((version_key(version), version) for version in versions)
+        self.keys = [key for key, _ in pairs]
+        self.versions = [version for _, version in pairs]
+        releases = [(key, version) for key, version in pairs if key[3] == 2]
+        self._release_keys = [key for key, _ in releases]
+        self._releases = [version for _, version in releases]
+
+    def __len__(self):
+        return len(self.versions)
+
+    def _ranges(self, spec):
+        # (keys, versions, lo, hi) slices holding the matches, None if the
+        # spec can't be expressed as bounds
+        lower = upper = None
+        prereleases = set()
+        for item in spec.specs:
+            try:
+                lower, upper = _tighter(lower, upper, *_bounds(item))
+            except ValueError:
+                return None
+            if item.kind != item.KIND_ANY and item.spec.prerelease:
+                prereleases.add((item.spec.major, item.spec.minor, item.spec.patch))
+        ranges = [(self._release_keys, self._releases) + _bisect(self._release_keys, lower, upper)]
+        for triple in sorted(prereleases):
+            band = _tighter(lower, upper, (triple + (1, ()), False), (triple + (2, ()), False))
+            ranges.append((self.keys, self.versions) + _bisect(self.keys, *band))
+        return ranges
+
+    def matching(self, spec):
+        # All versions matching spec, oldest first
+        ranges = self._ranges(spec)
+        if ranges is None:
+            return [version for version in self.versions if spec.match(semver.Version(version))]
+        if len(ranges) == 1:
+            _, versions, lo, hi = ranges[0]
+            return versions[lo:hi]
+        return [version for _, version in
+                sorted((key, version) for keys, versions, lo, hi in ranges
+                       for key, version in zip(keys[lo:hi], versions[lo:hi]))]
+
+    def best(self, spec):
+        # The newest version matching spec, None if there is none
+        ranges = self._ranges(spec)
+        if ranges is None:
+            matching = self.matching(spec)
+            return matching[-1] if matching else None
+        best = None
+        for keys, versions, lo, hi in ranges:
+            if hi > lo and (best is None or keys[hi - 1] > best[0]):
+                best = (keys[hi - 1], versions[hi - 1])
+        return best[1] if best is not None else None
+
+    def latest(self):
+        # Newest release, or newest pre-release when there are only those
+        if self._releases:
+            return self._releases[-1]
+        return self.versions[-1] if self.versions else None
+
+def _merge_kinds(requires, build_requires):
+    # Merged [dependencies] and [build-dependencies] requirements, and
+    # whether they came out as they went in
+    merged = merge_requirements(requires)
+    # Whatever [dependencies] already requires needn't be repeated
+    required = set((dep.name, dep.req, dep.features, dep.arches) for dep in merged)
+    build_merged = [dep for dep in merge_requirements(build_requires)
+                    if (dep.name, dep.req, dep.features, dep.arches) not in required]
+    unchanged = len(merged) == len(requires) and len(build_merged) == len(build_requires)
+    return tuple(merged), tuple(build_merged), unchanged
+
+# Which Metadata attribute a dependency ends up in
+REQUIRES_KINDS = {None: "requires", "build": "build_requires", "dev": "test_requires"}
+
+class Metadata(Immutable):
+    # Dependencies are kept as plain (attribute, name, req, features, extra,
+    # arches, enabled) tuples; the Dependency lists and Provides are each
+    # built on first access.
+    # requires, build_requires and test_requires list every dependency, as
+    # the devel package needs them all. enabled_requires and
+    # enabled_build_requires only have those the feature selection turns on,
+    # with the features it turns on for them: what building takes. The other
+    # optional ones are in optional_requires.
+    __slots__ = ("name", "license", "license_file", "description", "version",
+                 "targets", "features", "_provided", "_deps", "_lazy")
+
+    def __init__(self, name=None, version=None, license=None, license_file=None,
+                 description=None, targets=(), features=(), provided=(), deps=()):
+        self._set(name=name, version=version, license=license, license_file=license_file,
+                  description=description, targets=tuple(targets), features=tuple(features),
+                  _provided=tuple(provided), _deps=tuple(deps), _lazy=None)
+
+    def _lazy_get(self, key, evaluate):
+        lazy = self._lazy
+        if lazy is None:
+            lazy = {}
+            object.__setattr__(self, "_lazy", lazy)
+        if key not in lazy:
+            lazy.update(evaluate())
+        return lazy[key]
+
+    def _requirements(self):
+        lazy = {}
+        deps = {"requires": [], "build_requires": [], "test_requires": []}
+        enabled = {"requires": [], "build_requires": []}
+        optional = []
+        extended = False
+        for attr, name, req, features, extra, arches, on in self._deps:
+            dep = Dependency(name, req, features=features, arches=arches)
+            deps[attr].append(dep)
+            if attr == "test_requires":
+                continue
+            if not on:
+                optional.append(dep)
+            elif extra:
+                extended = True
+                enabled[attr].append(Dependency(name, req, features=features + extra,
+                                                arches=arches))
+            else:
+                enabled[attr].append(dep)
+        lazy["requires"], lazy["build_requires"], unchanged = \
+            _merge_kinds(deps["requires"], deps["build_requires"])
+        lazy["test_requires"] = tuple(merge_requirements(deps["test_requires"]))
+        lazy["optional_requires"] = tuple(merge_requirements(optional))
+        if extended or not unchanged:
+            lazy["enabled_requires"], lazy["enabled_build_requires"], _ = \
+                _merge_kinds(enabled["requires"], enabled["build_requires"])
+        elif optional:
+            # Part of requirements that needed no merging needs none either
+            lazy["enabled_requires"] = tuple(enabled["requires"])
+            lazy["enabled_build_requires"] = tuple(enabled["build_requires"])
+        else:
+            lazy["enabled_requires"] = lazy["requires"]
+            lazy["enabled_build_requires"] = lazy["build_requires"]
+        return lazy
+
+    def _provides(self):
+        provides = Dependency(self.name, "={}".format(self.version), features=self._provided,
+                              provides=True)
+        return {"provides": tuple(str(provides).split(" and "))}
+
+    @property
+    def provides(self):
+        return self._lazy_get("provides", self._provides)
+
+    @property
+    def requires(self):
+        return self._lazy_get("requires", self._requirements)
+
+    @property
+    def build_requires(self):
+        return self._lazy_get("build_requires", self._requirements)
+
+    @property
+    def test_requires(self):
+        return self._lazy_get("test_requires", self._requirements)
+
+    @property
+    def optional_requires(self):
+        return self._lazy_get("optional_requires", self._requirements)
 
-        # Targets
-        self.targets = [Target(tgt["kind"][0], tgt["name"]) for tgt in md["targets"]]
+    @property
+    def enabled_requires(self):
+        return self._lazy_get("enabled_requires", self._requirements)
+
+    @property
+    def enabled_build_requires(self):
+        return self._lazy_get("enabled_build_requires", self._requirements)
+
+    @classmethod
+    @timed("metadata")
+    def from_json(cls, metadata, features=(), default_features=True, all_features=False,
+                  arches=RUST_ARCHES):
+        md = metadata
+        targets = [Target(tgt["kind"][0], tgt["name"]) for tgt in md["targets"]]
 
         # Provides
         # All optional depdencies are also features
         # https://github.com/rust-lang/cargo/issues/4911
-        features = itertools.chain((x["name"] for x in md["dependencies"] if x["optional"]),
+        # Newer cargo also lists those as implicit features, so deduplicate
+        provided = itertools.chain((x.get("rename") or x["name"] for x in md["dependencies"] if x["optional"]),
                                    md["features"])
-        provides = Dependency(self.name, version, features=features, provides=True)
-        self.provides = str(provides).split(" and ")
+        provided = collections.OrderedDict.fromkeys(provided)
 
         # Dependencies
+        # Optional ones are only needed for building when the feature
+        # selection (by default, the default features) turns them on.
+        # Platform specific ones are dropped unless they apply to one of the
+        # arches.
+        enabled, activated, extra = resolve_features(md["features"], md["dependencies"],
+                                                     features, default_features, all_features)
+        arches = tuple(arches)
+        deps = []
         for dep in md["dependencies"]:
-            if dep["kind"] is None:
-                requires = self.requires
-            elif dep["kind"] == "build":
-                requires = self.build_requires
-            elif dep["kind"] == "dev":
-                requires = self.test_requires
-            else:
+            key = dep.get("rename") or dep["name"]
+            dep_features = tuple(dep["features"])
+            dep_extra = ()
+            if key in extra:
+                dep_extra = tuple(sorted(extra[key] - set(dep_features)))
+            dep_arches = target_arches(dep.get("target"), arches)
+            if not dep_arches:
+                continue
+            if len(dep_arches) == len(arches):
+                dep_arches = None
+            if dep["kind"] not in REQUIRES_KINDS:
                 raise ValueError("Unknown kind: {!r}, please report bug.".format(dep["kind"]))
-            requires.append(Dependency(dep["name"], dep["req"], features=dep["features"]))
+            deps.append((REQUIRES_KINDS[dep["kind"]], dep["name"], dep["req"], dep_features,
+                         dep_extra, dep_arches, not dep["optional"] or key in activated))
 
-        return self
+        return cls(name=md["name"], version=md["version"], license=md["license"],
+                   license_file=md["license_file"], description=md.get("description"),
+                   targets=targets, features=sorted(enabled), provided=provided, deps=deps)
 
     @classmethod
-    def from_file(cls, path):
-        do_decode = sys.version_info < (3, 6)
-        metadata = subprocess.check_output(["cargo", "read-manifest",
-                                            "--manifest-path={}".format(path)],
-                                           universal_newlines=do_decode)
-        return cls.from_json(json.loads(metadata))
+    def from_file(cls, path, use_cargo=None, **kwargs):
+        return cls.from_json(load_manifest(path, use_cargo), **kwargs)
+
+    @classmethod
+    def from_workspace(cls, path, **kwargs):
+        return [cls.from_json(manifest, **kwargs) for manifest in workspace_read_manifests(path)]
+
+def resolve_features(table, dependencies, requested=(), default_features=True, all_features=False):
+    # Walks the [features] graph the way cargo does. Returns the enabled
+    # features, the optional dependencies they turn on and the features
+    # they add to each dependency, by dependency name (or rename).
+    #   "feat"         another feature, or an optional dependency of that name
+    #   "dep:name"     an optional dependency, without the implicit feature
+    #   "name/feat"    a feature of a dependency, turning it on if optional
+    #   "name?/feat"   a feature of a dependency, only if it is on anyway
+    optional = set()
+    known = set()
+    for dep in dependencies:
+        key = dep.get("rename") or dep["name"]
+        known.add(key)
+        if dep["optional"]:
+            optional.add(key)
+    explicit = set(item[4:] for items in table.values() for item in items
+                   if item.startswith("dep:"))
+
+    enabled = set()
+    activated = set()
+    extra = collections.defaultdict(set)
+    weak = []
+
+    pending = list(requested)
+    if all_features:
+        pending.extend(table)
+        pending.extend("dep:{}".format(key) for key in optional)
+    if default_features and "default" in table:
+        pending.append("default")
+    while pending:
+        item = pending.pop()
+        if item.startswith("dep:"):
+            if item[4:] in optional:
+                activated.add(item[4:])
+        elif "/" in item:
+            key, feature = item.split("/", 1)
+            if key.endswith("?"):
+                weak.append((key[:-1], feature))
+                continue
+            if key in table:
+                pending.append(key)
+            if key not in known:
+                if key not in table:
+                    raise ValueError("Feature {!r} refers to unknown dependency {!r}".format(item, key))
+                continue
+            if key in optional:
+                activated.add(key)
+                if key not in explicit:
+                    enabled.add(key)
+            extra[key].add(feature)
+        elif item in enabled:
+            continue
+        elif item in table:
+            enabled.add(item)
+            pending.extend(table[item])
+        elif item in optional and item not in explicit:
+            enabled.add(item)
+            activated.add(item)
+        else:
+            raise ValueError("Unknown feature: {!r}".format(item))
+
+    for key, feature in weak:
+        if key in known and (key not in optional or key in activated):
+            extra[key].add(feature)
+    return enabled, activated, extra
+
+def add_feature_arguments(parser):
+    group = parser.add_argument_group("feature selection",
+                                      "Which optional dependencies BuildRequires include, "
+                                      "as with cargo build (default: the default features)")
+    group.add_argument("-F", "--features", action="append", default=[],
+                       help="Comma or space separated list of features to enable")
+    group.add_argument("--all-features", action="store_true", help="Enable all features")
+    group.add_argument("--no-default-features", action="store_true",
+                       help="Do not enable the default features")
+
+def feature_kwargs(args):
+    # Metadata.from_json keyword arguments for the selection in args
+    features = [feature for value in args.features for feature in re.split(r"[\s,]+", value)
+                if feature]
+    return {"features": features, "default_features": not args.no_default_features,
+            "all_features": args.all_features}
+
+def load_manifest(path, use_cargo=None):
+    if use_cargo is None:
+        use_cargo = toml_loads is None
+        if not use_cargo:
+            try:
+                return toml_read_manifest(path)
+            except UnsupportedManifest:
+                use_cargo = True
+    if use_cargo:
+        return cargo_read_manifest(path)
+    else:
+        return toml_read_manifest(path)
+
+@timed("parse")
+def cargo_read_manifest(path):
+    import subprocess
+    do_decode = sys.version_info < (3, 6)
+    metadata = subprocess.check_output(["cargo", "read-manifest",
+                                        "--manifest-path={}".format(path)],
+                                       universal_newlines=do_decode)
+    return json.loads(metadata)
+
+@timed("parse")
+def cargo_metadata(path):
+    import subprocess
+    do_decode = sys.version_info < (3, 6)
+    metadata = subprocess.check_output(["cargo", "metadata", "--no-deps", "--offline",
+                                        "--format-version=1",
+                                        "--manifest-path={}".format(path)],
+                                       universal_newlines=do_decode)
+    return json.loads(metadata)
+
+def workspace_read_manifests(path):
+    # Manifests of all workspace members, dependencies first. Path
+    # dependencies on other members without a version get the member's
+    # version as caret requirement.
+    metadata = cargo_metadata(path)
+    ids = set(metadata["workspace_members"])
+    packages = dict((os.path.dirname(pkg["manifest_path"]), pkg)
+                    for pkg in metadata["packages"] if pkg["id"] in ids)
+
+    for package in packages.values():
+        for dep in package["dependencies"]:
+            member = packages.get(dep.get("path"))
+            if member is not None and dep["req"] == "*":
+                dep["req"] = "^{}".format(member["version"])
+
+    order = []
+    seen = set()
+
+    def visit(root):
+        if root in seen:
+            return
+        seen.add(root)
+        for dep in packages[root]["dependencies"]:
+            if dep.get("path") in packages and dep["kind"] != "dev":
+                visit(dep["path"])
+        order.append(packages[root])
+
+    for root in sorted(packages, key=lambda root: packages[root]["name"]):
+        visit(root)
+    return order
+
+def manifest_files(root):
+    files = set()
+    for name in ("build.rs", "src/lib.rs", "src/main.rs"):
+        if os.path.isfile(os.path.join(root, name)):
+            files.add(name)
+    for subdir in ("src/bin", "examples", "tests", "benches"):
+        for dirpath, dirnames, filenames in os.walk(os.path.join(root, subdir)):
+            relpath = os.path.relpath(dirpath, root)
+            files.update(os.path.join(relpath, f) for f in filenames)
+    return files
+
+def toml_read_manifest(path):
+    with open(path, "r", encoding="utf-8") as fobj:
+        contents = fobj.read()
+    root = os.path.dirname(os.path.abspath(path))
+    return read_manifest(contents, manifest_files(root), root=root)
+
+def crate_read_manifest(path, prefix):
+    # Single pass over the compressed archive: the member list is enough to
+    # infer targets, so only Cargo.toml itself is ever read.
+    import tarfile
+    prefix = prefix.rstrip("/") + "/"
+    contents = None
+    files = set()
+    with TIMINGS.phase("extract"), tarfile.open(path, "r|*") as archive:
+        for member in archive:
+            if not member.name.startswith(prefix) or not member.isfile():
+                continue
+            name = member.name[len(prefix):]
+            files.add(name)
+            if name == "Cargo.toml":
+                contents = archive.extractfile(member).read().decode("utf-8")
+                TIMINGS.add_bytes("extract", member.size)
+    if contents is None:
+        raise ValueError("No {}Cargo.toml in {}".format(prefix, path))
+    return read_manifest(contents, files)
+
+DEPENDENCY_KINDS = (
+    ("dependencies", None),
+    ("dev-dependencies", "dev"),
+    ("dev_dependencies", "dev"),
+    ("build-dependencies", "build"),
+    ("build_dependencies", "build"),
+)
+
+def _normalize_req(req):
+    parts = []
+    for part in req.split(","):
+        part = re.sub(r"\s+", "", part)
+        if part[:1].isdigit() and "*" not in part:
+            # Bare versions are caret requirements
+            part = "^{}".format(part)
+        parts.append(part)
+    return ", ".join(parts)
+
+def _read_dependencies(table, kind, target, root):
+    deps = []
+    for key, value in table.items():
+        if isinstance(value, str):
+            value = {"version": value}
+        if "workspace" in value:
+            raise UnsupportedManifest("Inherited dependency: {!r}".format(key))
+        package = value.get("package")
+        dep = {
+            "name": package or key,
+            "rename": key if package is not None else None,
+            "req": _normalize_req(value.get("version", "*")),
+            "kind": kind,
+            "optional": value.get("optional", False),
+            "uses_default_features": value.get("default-features",
+                                               value.get("default_features", True)),
+            "features": value.get("features", []),
+            "target": target,
+        }
+        if "path" in value:
+            dep["path"] = value["path"]
+            if root is not None:
+                dep["path"] = os.path.normpath(os.path.join(root, dep["path"]))
+        deps.append(dep)
+    return deps
+
+TABLE_HEADER = re.compile(r"^\s*\[\[?\s*(?P<key>[^\]]+?)\s*\]\]?\s*(#.*)?$")
+KEY_PART = re.compile(r"""\s*(?:"(?P<basic>(?:[^"\\]|\\.)*)"|'(?P<literal>[^']*)'|(?P<bare>[A-Za-z0-9_-]+))\s*(?:\.|$)""")
+
+def _table_key(key):
+    parts = []
+    pos = 0
+    while pos < len(key):
+        match = KEY_PART.match(key, pos)
+        if match is None:
+            return None
+        if match.group("basic") is not None:
+            parts.append(re.sub(r"\\(.)", r"\1", match.group("basic")))
+        else:
+            parts.append(match.group("literal") if match.group("literal") is not None
+                         else match.group("bare"))
+        pos = match.end()
+    return parts
+
+def drop_foreign_targets(contents, arches=RUST_ARCHES):
+    # Cargo.toml without the [target.<target>] tables that apply to none of
+    # arches: cargo resolves every platform's dependencies, which the local
+    # registry of an offline build doesn't have. Works on the lines, so the
+    # rest of the file stays as it is.
+    if "[target." not in contents:
+        return contents
+    lines = []
+    dropping = False
+    for line in contents.splitlines(True):
+        match = TABLE_HEADER.match(line)
+        if match is not None:
+            key = _table_key(match.group("key"))
+            dropping = key is not None and len(key) >= 2 and key[0] == "target" and \
+                not target_arches(key[1], tuple(arches))
+        if not dropping:
+            lines.append(line)
+    return "".join(lines)
+
+# [package] keys turning target auto-discovery off
+AUTO_DISCOVERY = {"bin": "autobins", "example": "autoexamples", "test": "autotests",
+                  "bench": "autobenches"}
+
+def _read_targets(manifest, files, root):
+    package = manifest["package"]
+    edition = package.get("edition", "2015")
+    targets = []
+
+    def make_target(kind, name, src_path, crate_types=None):
+        if root is not None:
+            src_path = os.path.join(root, src_path)
+        return {"kind": kind, "crate_types": crate_types or kind,
+                "name": name, "src_path": src_path, "edition": edition}
+
+    # Library
+    lib = manifest.get("lib")
+    lib_path = "src/lib.rs"
+    if lib is not None and "path" in lib:
+        lib_path = lib["path"]
+    if lib is not None or lib_path in files:
+        lib = lib or {}
+        crate_types = lib.get("crate-type", lib.get("crate_type"))
+        if crate_types is None:
+            proc_macro = lib.get("proc-macro", lib.get("proc_macro", False))
+            crate_types = ["proc-macro"] if proc_macro else ["lib"]
+        name = lib.get("name", package["name"].replace("-", "_"))
+        targets.append(make_target(crate_types, name, lib_path))
+
+    def discover(kind, subdir, inferred):
+        explicit = manifest.get(kind, [])
+        # In 2015 edition, declaring any target disables auto-discovery
+        if package.get(AUTO_DISCOVERY[kind], edition != "2015" or not explicit):
+            known = set(tgt["name"] for tgt in explicit)
+            known.update(tgt["path"] for tgt in explicit if "path" in tgt)
+            explicit = explicit + [{"name": name, "path": path}
+                                   for name, path in sorted(inferred)
+                                   if name not in known and path not in known]
+        for tgt in sorted(explicit, key=lambda tgt: tgt["name"]):
+            path = tgt.get("path", "{}/{}.rs".format(subdir, tgt["name"]))
+            targets.append(make_target([kind], tgt["name"], path, ["bin"]))
+
+    def infer(subdir):
+        inferred = []
+        for f in files:
+            parts = f.split("/")
+            if "/".join(parts[:-1]) == subdir and parts[-1].endswith(".rs"):
+                inferred.append((parts[-1][:-3], f))
+            elif "/".join(parts[:-2]) == subdir and parts[-1] == "main.rs":
+                inferred.append((parts[-2], f))
+        return inferred
+
+    bins = infer("src/bin")
+    if "src/main.rs" in files:
+        bins.append((package["name"], "src/main.rs"))
+    discover("bin", "src/bin", bins)
+    discover("example", "examples", infer("examples"))
+    discover("test", "tests", infer("tests"))
+    discover("bench", "benches", infer("benches"))
+
+    # Build script
+    build = package.get("build")
+    if build is None and "build.rs" in files:
+        build = "build.rs"
+    if build:
+        targets.append(make_target(["custom-build"], "build-script-build", build, ["bin"]))
+
+    return targets
+
+@timed("parse")
+def read_manifest(contents, files, root=None):
+    if toml_loads is None:
+        raise UnsupportedManifest("No TOML parser available")
+    manifest = toml_loads(contents)
+    if "package" not in manifest:
+        raise UnsupportedManifest("No [package] section, is it a virtual manifest?")
+    package = manifest["package"]
+    for key, value in package.items():
+        if isinstance(value, dict) and "workspace" in value:
+            raise UnsupportedManifest("Inherited package key: {!r}".format(key))
+
+    deps = []
+    for section, kind in DEPENDENCY_KINDS:
+        deps.extend(_read_dependencies(manifest.get(section, {}), kind, None, root))
+    for target, table in manifest.get("target", {}).items():
+        for section, kind in DEPENDENCY_KINDS:
+            deps.extend(_read_dependencies(table.get(section, {}), kind, target, root))
+    kind_order = {None: 0, "dev": 1, "build": 2}
+    deps.sort(key=lambda dep: (dep["target"] or "", kind_order[dep["kind"]], dep["name"]))
+
+    return {
+        "name": package["name"],
+        "version": package.get("version", "0.0.0"),
+        "license": package.get("license"),
+        "license_file": package.get("license-file", package.get("license_file")),
+        "description": package.get("description"),
+        "edition": package.get("edition", "2015"),
+        "dependencies": deps,
+        "targets": _read_targets(manifest, files, root),
+        "features": collections.OrderedDict(sorted(manifest.get("features", {}).items())),
+    }
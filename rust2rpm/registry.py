@@ -0,0 +1,367 @@
+import concurrent.futures
+import json
+import os
+import tempfile
+import threading
+import time
+from urllib.parse import urljoin
+
+import semantic_version as semver
+
+from .cache import CACHEDIR, SIZE_FILE, file_digest, update_size
+from .metadata import Dependency, VersionIndex, version_key
+from .timing import TIMINGS, timed
+
+API_URL = "https://crates.io/api/v1/"
+INDEX_URL = "https://index.crates.io/"
+CHUNK_SIZE = 64 * 1024
+DEFAULT_JOBS = 8
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024
+# Index files younger than this are used without asking the server
+INDEX_TTL = 10 * 60
+
+# requests and tqdm are imported on first use, they dominate startup time
+def make_session(pool_size=DEFAULT_JOBS, retries=3, backoff=0.5):
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry = Retry(total=retries, backoff_factor=backoff,
+                  status_forcelist=(429, 500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def progress_bar(desc):
+    import tqdm
+    return tqdm.tqdm(desc=desc, total=0, unit="B", unit_scale=True)
+
+def index_path(crate):
+    crate = crate.lower()
+    if len(crate) <= 2:
+        return "{}/{}".format(len(crate), crate)
+    elif len(crate) == 3:
+        return "3/{}/{}".format(crate[0], crate)
+    else:
+        return "{}/{}/{}".format(crate[0:2], crate[2:4], crate)
+
+# Reads crates.io-index files, either from a sparse index URL or from a local
+# directory laid out like the crates.io-index git repository. Files fetched
+# over HTTP are kept in cachedir and revalidated with ETag/Last-Modified once
+# they are older than ttl; in offline mode they are used as they are.
+class Index(object):
+    def __init__(self, source=INDEX_URL, cachedir=os.path.join(CACHEDIR, "index"),
+                 session=None, ttl=INDEX_TTL, offline=False):
+        self.source = source
+        self.cachedir = cachedir
+        self.session = session
+        self.ttl = ttl
+        self.offline = offline
+        self._entries = {}
+
+    @property
+    def is_local(self):
+        return "://" not in self.source or self.source.startswith("file://")
+
+    def _read_local(self, crate):
+        root = self.source[len("file://"):] if self.source.startswith("file://") else self.source
+        try:
+            with open(os.path.join(root, index_path(crate)), "r") as fobj:
+                return fobj.read()
+        except FileNotFoundError:
+            raise LookupError("Crate {!r} not found in {}".format(crate, self.source))
+
+    def _read_remote(self, crate):
+        path = os.path.join(self.cachedir, index_path(crate))
+        meta_path = path + ".meta"
+        try:
+            age = time.time() - os.stat(path).st_mtime
+        except FileNotFoundError:
+            age = None
+        if age is not None and (self.offline or age < self.ttl):
+            with open(path, "r") as fobj:
+                return fobj.read()
+        if self.offline:
+            raise LookupError("Crate {!r} is not in the offline index cache".format(crate))
+
+        headers = {}
+        if age is not None:
+            try:
+                with open(meta_path, "r") as fobj:
+                    meta = json.load(fobj)
+            except (OSError, ValueError):
+                meta = {}
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last-modified"):
+                headers["If-Modified-Since"] = meta["last-modified"]
+
+        session = self.session or make_session()
+        req = session.get(urljoin(self.source, index_path(crate)),
+                          headers=headers)
+        if req.status_code == 304:
+            os.utime(path)
+            with open(path, "r") as fobj:
+                return fobj.read()
+        if req.status_code in (403, 404):
+            raise LookupError("Crate {!r} not found in {}".format(crate, self.source))
+        req.raise_for_status()
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        meta = {"etag": req.headers.get("ETag"),
+                "last-modified": req.headers.get("Last-Modified")}
+        for target, contents in ((path, req.text), (meta_path, json.dumps(meta))):
+            fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "w") as fobj:
+                fobj.write(contents)
+            os.replace(tmppath, target)
+        return req.text
+
+    @timed("lookup")
+    def entries(self, crate):
+        entries = self._entries.get(crate)
+        if entries is None:
+            if self.is_local:
+                contents = self._read_local(crate)
+            else:
+                contents = self._read_remote(crate)
+            entries = [json.loads(line) for line in contents.splitlines() if line.strip()]
+            entries.sort(key=lambda entry: version_key(entry["vers"]), reverse=True)
+            self._entries[crate] = entries
+        return entries
+
+    def entry(self, crate, version):
+        for entry in self.entries(crate):
+            if entry["vers"] == version:
+                return entry
+        raise LookupError("Crate {}-{} not found in {}".format(crate, version, self.source))
+
+    def versions(self, crate):
+        return [entry["vers"] for entry in self.entries(crate) if not entry["yanked"]]
+
+# Downloaded crates are shared between concurrent rust2rpm processes: each
+# entry is written to a .part file under an exclusive lock on its .lock file
+# and renamed into place once its checksum is verified, so a crate file in
+# cachedir is always complete. Interrupted transfers resume from the .part
+# file. mtime is the LRU clock for evicting crates beyond max_size.
+class Downloader(object):
+    def __init__(self, api_url=API_URL, cachedir=CACHEDIR, jobs=DEFAULT_JOBS,
+                 session=None, progress=True, index=None, max_size=DEFAULT_CACHE_SIZE):
+        self.api_url = api_url
+        self.index = index
+        self.cachedir = cachedir
+        self.jobs = jobs
+        self.max_size = max_size
+        self.session = session or make_session(pool_size=jobs)
+        if index is not None and index.session is None:
+            index.session = self.session
+        self.progress = progress
+        self._lock = threading.Lock()
+        self._bar = None
+        self._versions = {}
+        self._indexes = {}
+        self._checksums = {}
+
+    def versions(self, crate):
+        # Non-yanked versions, newest first
+        if self.index is not None:
+            return self.index.versions(crate)
+        versions = self._versions.get(crate)
+        if versions is None:
+            url = urljoin(self.api_url, "crates/{}/versions".format(crate))
+            with TIMINGS.phase("lookup"):
+                req = self.session.get(url)
+            req.raise_for_status()
+            versions = []
+            for version in req.json()["versions"]:
+                if version.get("checksum"):
+                    self._checksums[(crate, version["num"])] = version["checksum"]
+                if not version["yanked"]:
+                    versions.append(version["num"])
+            self._versions[crate] = versions
+        return versions
+
+    def version_index(self, crate):
+        index = self._indexes.get(crate)
+        if index is None:
+            index = self._indexes[crate] = VersionIndex(self.versions(crate))
+        return index
+
+    def latest_version(self, crate):
+        version = self.version_index(crate).latest()
+        if version is None:
+            raise LookupError("No versions of {} available".format(crate))
+        return version
+
+    def select_version(self, crate, version=None):
+        # version may also be a requirement, the newest match is picked
+        if version is None:
+            return self.latest_version(crate)
+        try:
+            semver.Version(version)
+            return version
+        except ValueError:
+            pass
+        selected = self.version_index(crate).best(Dependency(crate, version).spec)
+        if selected is None:
+            raise LookupError("No version of {} matches {}".format(crate, version))
+        return selected
+
+    def checksum(self, crate, version, lookup=True):
+        # Expected SHA-256 of the .crate file, None when the registry doesn't
+        # say (or when lookup is off and it hasn't been asked yet)
+        if self.index is not None:
+            if not lookup and crate not in self.index._entries:
+                return None
+            try:
+                return self.index.entry(crate, version).get("cksum")
+            except LookupError:
+                return None
+        if lookup and crate not in self._versions:
+            self.versions(crate)
+        return self._checksums.get((crate, version))
+
+    def _update(self, total=0, done=0):
+        if self._bar is None:
+            return
+        with self._lock:
+            if total:
+                self._bar.total = (self._bar.total or 0) + total
+                self._bar.refresh()
+            if done:
+                self._bar.update(done)
+
+    def _download(self, url, partf, cratef_base):
+        # Appends to partf, resuming where an earlier attempt stopped
+        try:
+            offset = os.path.getsize(partf)
+        except FileNotFoundError:
+            offset = 0
+        headers = {"Range": "bytes={}-".format(offset)} if offset else {}
+        with TIMINGS.phase("download"), self.session.get(url, stream=True, headers=headers) as req:
+            if req.status_code == 416:
+                # Whatever is there can't be a prefix of the crate
+                os.unlink(partf)
+                return self._download(url, partf, cratef_base)
+            req.raise_for_status()
+            if req.status_code != 206:
+                offset = 0
+            own_bar = self._bar is None and self.progress
+            if own_bar:
+                self._bar = progress_bar("Downloading {}".format(cratef_base))
+            try:
+                self._update(total=int(req.headers.get("Content-Length", 0)))
+                with open(partf, "ab" if offset else "wb") as f:
+                    for chunk in req.iter_content(CHUNK_SIZE):
+                        f.write(chunk)
+                        self._update(done=len(chunk))
+                        TIMINGS.add_bytes("download", len(chunk))
+            finally:
+                if own_bar:
+                    self._bar.close()
+                    self._bar = None
+        return offset
+
+    def fetch(self, crate, version=None):
+        import fcntl
+
+        version = self.select_version(crate, version)
+
+        os.makedirs(self.cachedir, exist_ok=True)
+        cratef_base = "{}-{}.crate".format(crate, version)
+        cratef = os.path.join(self.cachedir, cratef_base)
+        partf = cratef + ".part"
+        with open(cratef + ".lock", "a") as lockf:
+            # Other processes fetching the same crate wait here
+            fcntl.flock(lockf.fileno(), fcntl.LOCK_EX)
+            if os.path.isfile(cratef):
+                # Complete by construction, only verified when the checksum is at hand
+                cksum = self.checksum(crate, version, lookup=False)
+                if cksum is None or file_digest(cratef) == cksum:
+                    os.utime(cratef)
+                    return cratef, crate, version
+                size = os.path.getsize(cratef)
+                os.unlink(cratef)
+                self._update_size(-size)
+
+            cksum = self.checksum(crate, version)
+
+            url = urljoin(self.api_url, "crates/{}/{}/download".format(crate, version))
+            offset = self._download(url, partf, cratef_base)
+            if offset and cksum is not None and file_digest(partf) != cksum:
+                # The resumed prefix may be what is broken, start over once
+                os.unlink(partf)
+                self._download(url, partf, cratef_base)
+            if cksum is not None and file_digest(partf) != cksum:
+                os.unlink(partf)
+                raise ValueError("Checksum mismatch for {}, expected {}".format(cratef_base, cksum))
+            os.replace(partf, cratef)
+            total = self._update_size(os.path.getsize(cratef))
+        if total is not None and total > self.max_size:
+            self.evict(keep=cratef)
+        return cratef, crate, version
+
+    def _update_size(self, delta=0, total=None):
+        # Running total of the crate sizes, so a fetch doesn't have to stat
+        # the whole cache; None without a size limit
+        if self.max_size is None:
+            return None
+        return update_size(os.path.join(self.cachedir, SIZE_FILE), self.entries, delta, total)
+
+    def entries(self):
+        entries = []
+        for name in os.listdir(self.cachedir):
+            if not name.endswith(".crate"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cachedir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, os.path.join(self.cachedir, name)))
+        return entries
+
+    def evict(self, keep=None):
+        import fcntl
+
+        if self.max_size is None:
+            return
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            with open(path + ".lock", "a") as lockf:
+                try:
+                    fcntl.flock(lockf.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    # Being fetched right now
+                    continue
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            total -= size
+        self._update_size(total=total)
+
+    def fetch_many(self, entries):
+        # Results come back in order, failed entries hold their exception
+        def fetch(entry):
+            try:
+                return self.fetch(*entry)
+            except Exception as e:
+                return e
+
+        if self.progress:
+            self._bar = progress_bar("Downloading {} crates".format(len(entries)))
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                return list(executor.map(fetch, entries))
+        finally:
+            if self._bar is not None:
+                self._bar.close()
+                self._bar = None
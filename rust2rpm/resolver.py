@@ -0,0 +1,144 @@
+import collections
+import concurrent.futures
+import itertools
+
+from .metadata import version_key
+
+def compat_series(version):
+    # Cargo considers versions compatible up to the leftmost non-zero part
+    major, minor, patch = version_key(version)[:3]
+    if major != 0:
+        return "{}".format(major)
+    if minor != 0:
+        return "0.{}".format(minor)
+    return "0.0.{}".format(patch)
+
+class Node(object):
+    def __init__(self, name, version):
+        self.name = name
+        self.version = version
+        self.cratef = None
+        self.metadata = None
+        self.deps = set()
+        # Asked for by the crates depending on it
+        self.features = set()
+
+    @property
+    def key(self):
+        return (self.name, compat_series(self.version))
+
+    def __repr__(self):
+        return "<Node {self.name}-{self.version}>".format(self=self)
+
+class Resolver(object):
+    def __init__(self, downloader, load, jobs=8):
+        self.downloader = downloader
+        self.load = load
+        self.jobs = jobs
+        self.nodes = {}
+        self.warnings = []
+        self.root = None
+        self.selection = {}
+
+    def _select(self, reqs, index):
+        # Group requirements by the series their newest match falls into,
+        # then prefer a version that satisfies the whole group.
+        groups = collections.OrderedDict()
+        for dep in reqs:
+            candidates = index.matching(dep.spec)
+            if not candidates:
+                self.warnings.append("No version of {} matches {}".format(dep.name, dep))
+                continue
+            series = compat_series(candidates[-1])
+            groups.setdefault(series, []).append((dep, candidates))
+        for series, group in groups.items():
+            common = set(group[0][1])
+            for _, candidates in group[1:]:
+                common &= set(candidates)
+            yield group, max(common or group[0][1], key=version_key)
+
+    def _load(self, node, result):
+        kwargs = dict(self.selection) if node is self.root else {}
+        kwargs["features"] = sorted(node.features)
+        try:
+            return self.load(*result, **kwargs)
+        except ValueError as e:
+            if not node.features or node is self.root:
+                raise
+            self.warnings.append("{}: {}, using the default features".format(node, e))
+            return self.load(*result)
+
+    def resolve(self, crate, version=None, features=(), **selection):
+        # The root gets built with features and the other from_json
+        # arguments in selection; every other crate with its default
+        # features plus whatever its dependents ask for.
+        version = self.downloader.select_version(crate, version)
+        root = self.root = Node(crate, version)
+        root.features.update(features)
+        self.selection = selection
+        self.nodes[root.key] = root
+        pending = [root]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while pending:
+                results = self.downloader.fetch_many([(n.name, n.version) for n in pending])
+                for node, result in zip(pending, results):
+                    if isinstance(result, Exception):
+                        raise result
+                    node.cratef = result[0]
+                    node.metadata = self._load(node, result)
+
+                # Requirements of this wave, by crate name
+                reqs = collections.OrderedDict()
+                for node in pending:
+                    md = node.metadata
+                    for dep in itertools.chain(md.enabled_requires, md.enabled_build_requires):
+                        reqs.setdefault(dep.name, []).append((node, dep))
+
+                names = sorted(reqs)
+                indexes = executor.map(self.downloader.version_index, names)
+                pending = []
+                for name, available in zip(names, indexes):
+                    deps = [dep for _, dep in reqs[name]]
+                    for group, version in self._select(deps, available):
+                        key = (name, compat_series(version))
+                        target = self.nodes.get(key)
+                        if target is None:
+                            target = self.nodes[key] = Node(name, version)
+                            pending.append(target)
+                        requested = set()
+                        for dep, candidates in group:
+                            requested.update(dep.features)
+                            if target.version not in candidates:
+                                self.warnings.append("{} does not satisfy {}".format(target, dep))
+                        if not requested <= target.features:
+                            # Loaded again with the new features, which may
+                            # turn on more of its dependencies
+                            target.features.update(requested)
+                            if target.metadata is not None and target not in pending:
+                                pending.append(target)
+                        group_deps = set(id(dep) for dep, _ in group)
+                        for node, dep in reqs[name]:
+                            if id(dep) in group_deps and node is not target:
+                                node.deps.add(key)
+
+        return root
+
+    def build_order(self):
+        # Kahn's algorithm, dependencies first; ties are broken by name so
+        # the order is stable between runs.
+        remaining = {key: set(node.deps) for key, node in self.nodes.items()}
+        order = []
+        while remaining:
+            ready = sorted(key for key, deps in remaining.items() if not deps)
+            if not ready:
+                # Break the cycle at the crate with the fewest dependencies
+                key = min(remaining, key=lambda key: (len(remaining[key]), key))
+                self.warnings.append("Breaking dependency cycle at {}".format(self.nodes[key]))
+                ready = [key]
+            for key in ready:
+                del remaining[key]
+            for deps in remaining.values():
+                deps.difference_update(ready)
+            order.extend(self.nodes[key] for key in ready)
+        return order
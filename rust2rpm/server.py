@@ -0,0 +1,105 @@
+import argparse
+import io
+import json
+import os
+import socketserver
+import threading
+
+from .cache import MetadataCache
+from .inspector import get_parser, inspect, parse_args, selects_features
+
+class MemoryCache(object):
+    def __init__(self, loader):
+        self._loader = loader
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def load(self, path):
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry is not None and entry[0] == stamp:
+            return entry[1]
+        md = self._loader(path)
+        with self._lock:
+            self._entries[path] = (stamp, md)
+        return md
+
+class RequestParser(argparse.ArgumentParser):
+    # Writes usage, help and errors into the request's buffers: requests
+    # are handled in threads, so sys.stdout and sys.stderr can't be swapped
+    def __init__(self, stdout, stderr, **kwargs):
+        super().__init__(**kwargs)
+        self.stdout = stdout
+        self.stderr = stderr
+
+    def print_usage(self, file=None):
+        super().print_usage(file or self.stdout)
+
+    def print_help(self, file=None):
+        super().print_help(file or self.stdout)
+
+    def exit(self, status=0, message=None):
+        if message:
+            self.stderr.write(message)
+        raise SystemExit(status)
+
+    def error(self, message):
+        self.print_usage(self.stderr)
+        self.exit(2, "{}: error: {}\n".format(self.prog, message))
+
+class InspectorHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        request = json.loads(line.decode("utf-8"))
+        stdout, stderr = io.StringIO(), io.StringIO()
+        status = 0
+        try:
+            parser = get_parser(RequestParser(stdout, stderr, prog=self.server.prog))
+            args = parse_args(parser, request["argv"])
+            if args.server is not None or args.registry is not None:
+                raise ValueError("--server and --registry are not supported through the client")
+            files = args.file or request.get("stdin", "").splitlines()
+            files = [os.path.join(request["cwd"], f.rstrip()) for f in files]
+            # The memory cache holds the default feature selection
+            load = None
+            if not (args.cargo or args.no_cache or selects_features(args)):
+                load = self.server.cache.load
+            inspect(args, files, out=stdout, load=load)
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            print("cargo-inspector: {}".format(e), file=stderr)
+            status = 1
+        response = {"status": status, "stdout": stdout.getvalue(), "stderr": stderr.getvalue()}
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+class InspectorServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    # rpm runs the dependency generators of a build in parallel
+    request_queue_size = 64
+
+    def __init__(self, path, loader=None):
+        self.prog = get_parser().prog
+        self.cache = MemoryCache(loader or MetadataCache().from_file)
+        if os.path.exists(path):
+            os.unlink(path)
+        umask = os.umask(0o077)
+        try:
+            super().__init__(path, InspectorHandler)
+        finally:
+            os.umask(umask)
+
+def serve(path, loader=None):
+    server = InspectorServer(path, loader)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
@@ -1,4 +1,15 @@
 {% include target ~ "-header.spec.inc" ignore missing %}
+{% macro build_requires(reqs, prefix="") %}
+{% for req in reqs|sort(attribute="name") %}
+{% if arch_conditional and req.arches %}
+{{ prefix }}%ifarch {{ req.arches|join(" ") }}
+{{ prefix }}BuildRequires:  {{ req }}
+{{ prefix }}%endif
+{% else %}
+{{ prefix }}BuildRequires:  {{ req }}
+{% endif %}
+{% endfor %}
+{% endmacro %}
 # Generated by rust2rpm
 %bcond_without check
 {% if not include_main %}
@@ -7,7 +18,7 @@
 
 %global crate {{ md.name }}
 
-Name:           rust-%{crate}
+Name:           rust-%{crate}{{ compat_suffix }}
 Version:        {{ md.version }}
 Release:        {{ pkg_release }}
 {% if md.description is none %}
@@ -36,25 +47,19 @@ ExclusiveArch:  %{rust_arches}
 
 BuildRequires:  rust-packaging
 {% if include_build_requires %}
-{% if md.requires|length > 0 %}
+{% if md.enabled_requires|length > 0 %}
 # [dependencies]
-{% for req in md.requires|sort(attribute="name") %}
-BuildRequires:  {{ req }}
-{% endfor %}
-{% endif %}
-{% if md.build_requires|length > 0 %}
+{{ build_requires(md.enabled_requires) }}{% endif %}
+{% if md.enabled_build_requires|length > 0 %}
 # [build-dependencies]
-{% for req in md.build_requires|sort(attribute="name") %}
-BuildRequires:  {{ req }}
-{% endfor %}
-{% endif %}
+{{ build_requires(md.enabled_build_requires) }}{% endif %}
+{% if md.optional_requires|length > 0 %}
+# Optional, only needed for non-default features
+{{ build_requires(md.optional_requires, "#") }}{% endif %}
 {% if md.test_requires|length > 0 %}
 %if %{with check}
 # [dev-dependencies]
-{% for req in md.test_requires|sort(attribute="name") %}
-BuildRequires:  {{ req }}
-{% endfor %}
-%endif
+{{ build_requires(md.test_requires) }}%endif
 {% endif %}
 {% endif %}
 
@@ -62,13 +67,13 @@ BuildRequires:  {{ req }}
 %{summary}.
 
 {% if include_main %}
-%package     -n %{crate}
+%package     -n %{crate}{{ compat_suffix }}
 Summary:        %{summary}
 {% if rust_group is defined %}
 Group:          # FIXME
 {% endif %}
 
-%description -n %{crate}
+%description -n %{crate}{{ compat_suffix }}
 %{summary}.
 
 {% endif %}
@@ -127,7 +132,7 @@ which use %{crate} from crates.io.
 %endif
 
 {% if include_main %}
-%files       -n %{crate}
+%files       -n %{crate}{{ compat_suffix }}
 {% if md.license_file is not none %}
 %license {{ md.license_file }}
 {% endif %}
@@ -0,0 +1,99 @@
+import collections
+import contextlib
+import functools
+import json
+import sys
+import threading
+import time
+
+# Phases run in worker threads overlap, so wall times add up to more than
+# the elapsed time; CPU time is process wide.
+class Timings(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.phases = collections.OrderedDict()
+            self.start = time.perf_counter()
+            self.cpu_start = time.process_time()
+
+    def add(self, name, wall=0.0, cpu=0.0, count=1, nbytes=0):
+        with self._lock:
+            phase = self.phases.setdefault(name, {"count": 0, "wall": 0.0, "cpu": 0.0, "bytes": 0})
+            phase["count"] += count
+            phase["wall"] += wall
+            phase["cpu"] += cpu
+            phase["bytes"] += nbytes
+
+    def add_bytes(self, name, nbytes):
+        self.add(name, count=0, nbytes=nbytes)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+    def as_dict(self):
+        with self._lock:
+            phases = collections.OrderedDict((name, dict(phase))
+                                             for name, phase in self.phases.items())
+        return collections.OrderedDict([
+            ("total", {"wall": time.perf_counter() - self.start,
+                       "cpu": time.process_time() - self.cpu_start}),
+            ("phases", phases),
+        ])
+
+    def report(self, fmt="table", file=None):
+        file = file or sys.stderr
+        data = self.as_dict()
+        if fmt == "json":
+            print(json.dumps(data), file=file)
+            return
+        row = "{:<16} {:>7} {:>10} {:>10} {:>12}"
+        print(row.format("phase", "count", "wall [s]", "cpu [s]", "bytes"), file=file)
+        for name, phase in data["phases"].items():
+            print(row.format(name, phase["count"], "{:.3f}".format(phase["wall"]),
+                             "{:.3f}".format(phase["cpu"]), phase["bytes"]), file=file)
+        total = data["total"]
+        print(row.format("total", "", "{:.3f}".format(total["wall"]),
+                         "{:.3f}".format(total["cpu"]), ""), file=file)
+
+TIMINGS = Timings()
+
+def timed(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with TIMINGS.phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def add_arguments(parser):
+    # A flag, so that it can't take the positional argument after it
+    parser.add_argument("--timings", action="store_true",
+                        help="Print time spent per phase to stderr")
+    parser.add_argument("--timings-format", choices=("table", "json"),
+                        help="Format of --timings (default: table), implies --timings")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="Write cProfile statistics to FILE")
+
+def instrumented(args, func, *func_args):
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        return func(*func_args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        if args.timings or args.timings_format:
+            TIMINGS.report(args.timings_format or "table")
@@ -0,0 +1,145 @@
+import re
+
+from .timing import timed
+
+# Updating an existing spec only touches what rust2rpm generates from the
+# crate metadata: the Version (and Release) tags and, in each preamble, the
+# region of crate BuildRequires/Requires/Provides. Everything else, and any
+# line a packager added inside such a region, is kept as it is.
+
+SECTION = re.compile(r"^%(package|description|prep|build|install|check|files|changelog|"
+                     r"pre|post|preun|postun|pretrans|posttrans|generate_buildrequires)\b")
+TAG = re.compile(r"^(?P<tag>Version|Release):(?P<space>\s*)(?P<value>.*)$")
+CRATE_DEP = re.compile(r"^#?\s*(BuildRequires|Requires|Provides):\s*\(?crate\(")
+HEADERS = ("# [dependencies]", "# [build-dependencies]", "# [dev-dependencies]",
+           "# Optional, only needed for non-default features")
+# Optional requirements come commented out, conditionals included
+CONDITIONAL = re.compile(r"^#?%(if|ifarch|ifnarch)\b")
+ENDIF = re.compile(r"^#?%endif\b")
+AUTOMATIC = ("%autorelease", "%autochangelog")
+
+def _generated(line):
+    return CRATE_DEP.match(line) or line.rstrip() in HEADERS or \
+        CONDITIONAL.match(line) or ENDIF.match(line)
+
+def _sections(lines):
+    # Maps the preamble of the main package (None) and of each %package to
+    # its (start, end) line range
+    sections = {}
+    name, start = None, 0
+    for i, line in enumerate(lines):
+        match = SECTION.match(line)
+        if match is None:
+            continue
+        if name not in sections:
+            sections[name] = (start, i)
+        name, start = None, i + 1
+        if match.group(1) == "package":
+            name = " ".join(line.split()[1:])
+    if name not in sections:
+        sections[name] = (start, len(lines))
+    return sections
+
+def _region(lines, start, end):
+    # (first, last + 1) of the generated dependency lines within start:end,
+    # None if there are none
+    anchors = [i for i in range(start, end)
+               if CRATE_DEP.match(lines[i]) or lines[i].rstrip() in HEADERS]
+    if not anchors:
+        return None
+    first, last = anchors[0], anchors[-1] + 1
+    depth = 0
+    for line in lines[first:last]:
+        if CONDITIONAL.match(line):
+            depth += 1
+        elif ENDIF.match(line):
+            depth -= 1
+    # Take in the conditionals wrapping the region
+    while depth > 0 and last < end and ENDIF.match(lines[last]):
+        last += 1
+        depth -= 1
+    while depth < 0 and first > start and CONDITIONAL.match(lines[first - 1]):
+        first -= 1
+        depth += 1
+    return first, last
+
+def _tag(lines, tag):
+    for i, line in enumerate(lines):
+        match = TAG.match(line)
+        if match is not None and match.group("tag") == tag:
+            return i, match
+        if SECTION.match(line):
+            break
+    return None, None
+
+def bump_release(release):
+    # "3%{?dist}" -> "4%{?dist}", "%mkrel 1" -> "%mkrel 2"
+    return re.sub(r"\d+", lambda match: str(int(match.group()) + 1), release, count=1)
+
+def release_number(release):
+    match = re.search(r"\d+", release)
+    return match.group() if match is not None else None
+
+@timed("update")
+def update_spec(old, new, changelog=None):
+    # Returns old with the generated parts taken from new (both spec file
+    # contents) and whether anything changed. changelog(release, changes)
+    # renders the entry to add; it's skipped with %autochangelog.
+    lines = old.split("\n")
+    new_lines = new.split("\n")
+    changes = []
+
+    # Dependency regions, bottom up so earlier line numbers stay valid
+    old_sections = _sections(lines)
+    new_sections = _sections(new_lines)
+    replaced = False
+    for name, (start, end) in sorted(old_sections.items(), key=lambda item: -item[1][0]):
+        old_region = _region(lines, start, end)
+        new_region = None
+        if name in new_sections:
+            new_region = _region(new_lines, *new_sections[name])
+        generated = new_lines[new_region[0]:new_region[1]] if new_region is not None else []
+        if old_region is None:
+            if not generated:
+                continue
+            # Goes after the last tag of the preamble
+            first = last = end
+            while first > start and not lines[first - 1].strip():
+                first = last = first - 1
+        else:
+            first, last = old_region
+        kept = [line for line in lines[first:last]
+                if line.strip() and line not in generated and not _generated(line)]
+        if [line for line in lines[first:last] if line.strip() and line not in kept] != generated:
+            lines[first:last] = generated + kept
+            replaced = True
+
+    version_index, version = _tag(lines, "Version")
+    new_version = _tag(new_lines, "Version")[1]
+    release_index, release = _tag(lines, "Release")
+    new_release = _tag(new_lines, "Release")[1]
+    version_changed = version is not None and new_version is not None and \
+        version.group("value").strip() != new_version.group("value").strip()
+    if version_changed:
+        lines[version_index] = "Version:{}{}".format(version.group("space"), new_version.group("value"))
+        changes.append("Update to version {}".format(new_version.group("value").strip()))
+    elif replaced:
+        changes.append("Regenerate dependencies")
+    if not changes:
+        return old, False
+
+    release_value = None
+    if release is not None and not any(m in release.group("value") for m in AUTOMATIC):
+        if version_changed and new_release is not None:
+            release_value = new_release.group("value")
+        else:
+            release_value = bump_release(release.group("value"))
+        lines[release_index] = "Release:{}{}".format(release.group("space"), release_value)
+
+    if changelog is not None and not any(line.startswith("%autochangelog") for line in lines):
+        for i, line in enumerate(lines):
+            if line.startswith("%changelog"):
+                entry = changelog(release_number(release_value or ""), changes).rstrip("\n")
+                lines[i + 1:i + 1] = entry.split("\n") + [""]
+                break
+    return "\n".join(lines), True
@@ -18,11 +18,13 @@ ARGS = dict(
         "console_scripts": [
             "rust2rpm = rust2rpm.__main__:main",
             "cargo-inspector = rust2rpm.inspector:main",
+            "cargo-inspector-client = rust2rpm.inspector_client:main",
         ],
     },
     install_requires=[
         # Metadata parser
         "semantic_version",
+        'toml; python_version < "3.11"',
 
         # CLI tool
         "jinja2",
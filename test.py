@@ -1,13 +1,22 @@
+import hashlib
+import io
+import itertools
+import json
 import os
+import re
 import shutil
+import socket
 import subprocess
 import sys
+import tarfile
 import tempfile
 import textwrap
+import threading
 
 import pytest
 
 import rust2rpm
+from fake_registry import FakeRegistry, make_crate
 
 DUMMY_LIB = """
 pub fn say_hello() {
@@ -15,6 +24,8 @@ pub fn say_hello() {
 }
 """
 DEPGEN = os.path.join(os.path.dirname(__file__), "cargodeps.py")
+# Seconds an entry point may spend importing its modules
+IMPORT_BUDGET = 0.5
 
 
 @pytest.mark.parametrize("req, features, rpmdep", [
@@ -31,6 +42,125 @@ def test_dependency(req, features, rpmdep):
     dep = rust2rpm.Dependency("test", req, features)
     assert str(dep) == rpmdep
 
+def test_merge_requirements():
+    import random
+    import semantic_version as semver
+    from rust2rpm.metadata import merge_requirements
+
+    rng = random.Random(1)
+    versions = ["{}.{}.{}".format(*v) for v in itertools.product((0, 1, 2), repeat=3)]
+    versions += ["0.1.0-alpha", "1.0.0-rc.1", "1.2.0-beta", "2.0.0-alpha.2"]
+    kinds = ["^", "~", "=", ">=", ">", "<", "<=", ""]
+    candidates = [semver.Version(v) for v in versions + ["0.0.1", "3.0.0", "1.1.5-pre"]]
+
+    def random_req():
+        if rng.random() < 0.1:
+            return "*"
+        parts = rng.choice(versions)
+        if rng.random() < 0.3:
+            parts = ".".join(parts.split("-")[0].split(".")[:rng.randint(1, 3)])
+        return rust2rpm.metadata._normalize_req(rng.choice(kinds) + parts)
+
+    for _ in range(500):
+        deps = [rust2rpm.Dependency("foo", random_req()) for _ in range(rng.randint(1, 3))]
+        merged = merge_requirements(deps)
+        assert 1 <= len(merged) <= len(deps)
+        for v in candidates:
+            assert all(dep.spec.match(v) for dep in deps) == \
+                   all(dep.spec.match(v) for dep in merged), (deps, merged, v)
+        if len(merged) == 1:
+            assert len(merged[0].spec.specs) <= 2
+            assert str(merged[0]).count("crate(foo)") <= 2
+
+    deps = [rust2rpm.Dependency("rand", "^0.7"), rust2rpm.Dependency("rand", "^0.8"),
+            rust2rpm.Dependency("rand", "^0.8.3", features=["std"]),
+            rust2rpm.Dependency("libc", "*"), rust2rpm.Dependency("libc", "^0.2")]
+    assert [str(dep) for dep in merge_requirements(deps)] == [
+        "(crate(rand) >= 0.7.0 with crate(rand) < 0.8.0)",
+        "(crate(rand) >= 0.8.0 with crate(rand) < 0.9.0)",
+        "((crate(rand) >= 0.8.3 with crate(rand) < 0.9.0) with crate(rand/std))",
+        "(crate(libc) >= 0.2.0 with crate(libc) < 0.3.0)"]
+
+def test_version_index():
+    import random
+    import semantic_version as semver
+    from rust2rpm.metadata import VersionIndex, version_key
+
+    versions = ["0.1.0", "0.1.1", "0.2.0-alpha", "0.2.0", "1.0.0-alpha", "1.0.0-alpha.1",
+                "1.0.0-alpha.beta", "1.0.0-beta.2", "1.0.0-beta.11", "1.0.0-rc.1", "1.0.0",
+                "1.0.1+build.5", "1.2.3", "1.10.0", "2.0.0-rc.1"]
+    # semver precedence
+    assert sorted(versions, key=version_key) == versions
+    assert [version_key(v) for v in versions] == [version_key(semver.Version(v)) for v in versions]
+    index = VersionIndex(reversed(versions))
+    assert index.versions == versions
+
+    def best(req):
+        return index.best(rust2rpm.Dependency("foo", req).spec)
+
+    assert index.latest() == "1.10.0"
+    assert best("*") == "1.10.0"
+    assert best("^0.1") == "0.1.1"
+    assert best("~1.0") == "1.0.1+build.5"
+    assert best("<1.0.0") == "0.2.0"
+    assert best(">=2") is None
+    # Pre-releases only match when asked for on the same x.y.z
+    assert best("=1.0.0-alpha") == "1.0.0-alpha"
+    assert best(">=1.0.0-beta.2, <=1.0.0-rc.1") == "1.0.0-rc.1"
+    assert best(">=1.0.0-beta.2, <1.0.0-rc.1") == "1.0.0-beta.11"
+    assert best(">=2.0.0-rc.1") == "2.0.0-rc.1"
+    assert VersionIndex(["2.0.0-rc.1"]).latest() == "2.0.0-rc.1"
+
+    # Same answers as checking each version, with cargo's pre-release rule
+    rng = random.Random(2)
+    kinds = ["^", "~", "=", ">=", ">", "<", "<=", ""]
+    for _ in range(300):
+        reqs = []
+        for _ in range(rng.randint(1, 2)):
+            parts = rng.choice(versions).split("+")[0]
+            if rng.random() < 0.4:
+                parts = ".".join(parts.split("-")[0].split(".")[:rng.randint(1, 3)])
+            reqs.append(rng.choice(kinds) + parts)
+        spec = rust2rpm.Dependency("foo", ", ".join(reqs)).spec
+        allowed = set((item.spec.major, item.spec.minor, item.spec.patch) for item in spec.specs
+                      if item.kind != item.KIND_ANY and item.spec.prerelease)
+        expected = [v for v in versions if spec.match(semver.Version(v)) and
+                    (not semver.Version(v).prerelease or version_key(v)[:3] in allowed)]
+        assert index.matching(spec) == expected, reqs
+        assert index.best(spec) == (expected[-1] if expected else None), reqs
+
+def test_dependency_cache():
+    rust2rpm.Dependency.cache_clear()
+    first = rust2rpm.Dependency("test", "=1.0.0")
+    second = rust2rpm.Dependency("other", "=1.0.0")
+    # Parsed requirements are shared and rendering must not modify them
+    assert first.spec is second.spec
+    assert str(first) == "crate(test) = 1.0.0"
+    assert str(second) == "crate(other) = 1.0.0"
+    assert str(rust2rpm.Dependency("test", "=1.0.0")) == "crate(test) = 1.0.0"
+    info = rust2rpm.Dependency.cache_info()
+    assert (info["parse"].hits, info["parse"].misses) == (3, 1)
+    assert (info["render"].hits, info["render"].misses) == (1, 2)
+
+def test_immutable():
+    dep = rust2rpm.Dependency("test", "^1.0.0")
+    with pytest.raises(AttributeError):
+        dep.req = "^2.0.0"
+    with pytest.raises(AttributeError):
+        dep.extra = True
+    md = rust2rpm.Metadata.from_json({
+        "name": "test", "version": "1.0.0", "license": None, "license_file": None,
+        "targets": [], "features": {},
+        "dependencies": [{"name": "libc", "req": "^0.2", "kind": None, "rename": None,
+                          "optional": False, "features": [], "target": None}],
+    })
+    with pytest.raises(AttributeError):
+        md.version = "2.0.0"
+    # Dependencies are only built when asked for
+    assert md._lazy is None
+    assert [str(x) for x in md.requires] == ["(crate(libc) >= 0.2.0 with crate(libc) < 0.3.0)"]
+    assert md.requires is md.requires
+
 @pytest.fixture
 def cargo_toml(request):
     def make_cargo_toml(contents):
@@ -99,6 +229,39 @@ def cargo_toml(request):
       "(crate(rand) >= 0.4.0 with crate(rand) < 0.5.0)",
       "(crate(serde) >= 1.0.0 with crate(serde) < 2.0.0)"]),
 
+    # Platform specific dependencies
+    ("""
+     [package]
+     name = "hello"
+     version = "0.0.0"
+
+     [target.'cfg(windows)'.dependencies]
+     winapi = "0.3"
+
+     [target.'cfg(target_os = "linux")'.dependencies]
+     libc = "0.2"
+     """,
+     ["crate(hello) = 0.0.0"],
+     ["(crate(libc) >= 0.2.0 with crate(libc) < 0.3.0)"]),
+
+    # Repeated dependencies are merged
+    ("""
+     [package]
+     name = "hello"
+     version = "0.0.0"
+
+     [dependencies]
+     log = "0.4"
+
+     [target.'cfg(unix)'.dependencies]
+     log = "0.4.8"
+
+     [target.'cfg(target_os = "linux")'.dependencies]
+     log = ">= 0.3, < 0.4.20"
+     """,
+     ["crate(hello) = 0.0.0"],
+     ["(crate(log) >= 0.4.8 with crate(log) < 0.4.20)"]),
+
     # Caret requirements
     ("""
      [package]
@@ -312,7 +475,933 @@ def cargo_toml(request):
      ["(crate(foo-bar) >= 1.2.3~beta with crate(foo-bar) < 1.2.3)"]),
 
 ])
-def test_depgen(toml, provides, requires, cargo_toml):
-    md = rust2rpm.Metadata.from_file(cargo_toml(toml))
+@pytest.mark.parametrize("use_cargo", [False, True], ids=["toml", "cargo"])
+def test_depgen(toml, provides, requires, use_cargo, cargo_toml):
+    md = rust2rpm.Metadata.from_file(cargo_toml(toml), use_cargo=use_cargo)
     assert [str(x) for x in md.provides] == provides
     assert [str(x) for x in md.requires] == requires
+
+def test_features(cargo_toml):
+    toml = cargo_toml("""
+                      [package]
+                      name = "hello"
+                      version = "1.0.0"
+
+                      [dependencies]
+                      libc = "0.2"
+                      serde = { version = "1", optional = true }
+                      rand = { version = "0.8", optional = true }
+                      log = { version = "0.4", optional = true }
+                      json = { version = "1", optional = true, package = "serde_json" }
+
+                      [build-dependencies]
+                      cc = { version = "1", optional = true }
+
+                      [features]
+                      default = ["std"]
+                      std = ["libc/std", "serde?/std", "dep:json"]
+                      derive = ["serde/derive"]
+                      random = ["rand", "build"]
+                      build = ["cc"]
+                      """)
+
+    def deps(md, name):
+        return [str(dep) for dep in getattr(md, name)]
+
+    md = rust2rpm.Metadata.from_file(toml)
+    assert md.features == ("default", "std")
+    assert deps(md, "enabled_requires") == [
+        "((crate(libc) >= 0.2.0 with crate(libc) < 0.3.0) with crate(libc/std))",
+        "(crate(serde_json) >= 1.0.0 with crate(serde_json) < 2.0.0)"]
+    assert deps(md, "enabled_build_requires") == []
+    assert [dep.name for dep in md.optional_requires] == ["log", "rand", "serde", "cc"]
+    # Whatever the selection, the devel package requires everything
+    complete = deps(md, "requires")
+    assert [dep.name for dep in md.requires] == ["libc", "log", "rand", "serde", "serde_json"]
+    assert complete[0] == "(crate(libc) >= 0.2.0 with crate(libc) < 0.3.0)"
+    assert [dep.name for dep in md.build_requires] == ["cc"]
+    complete += deps(md, "build_requires")
+
+    md = rust2rpm.Metadata.from_file(toml, features=["derive", "random"])
+    assert md.features == ("build", "cc", "default", "derive", "rand", "random", "serde", "std")
+    assert [dep.name for dep in md.enabled_requires] == ["libc", "rand", "serde", "serde_json"]
+    assert deps(md, "enabled_requires")[2] == \
+        "((crate(serde) >= 1.0.0 with crate(serde) < 2.0.0) with crate(serde/derive) with crate(serde/std))"
+    assert [dep.name for dep in md.enabled_build_requires] == ["cc"]
+    assert [dep.name for dep in md.optional_requires] == ["log"]
+    assert deps(md, "requires") + deps(md, "build_requires") == complete
+
+    md = rust2rpm.Metadata.from_file(toml, default_features=False)
+    assert md.features == ()
+    assert deps(md, "enabled_requires") == ["(crate(libc) >= 0.2.0 with crate(libc) < 0.3.0)"]
+
+    md = rust2rpm.Metadata.from_file(toml, all_features=True)
+    assert md.optional_requires == ()
+    assert deps(md, "requires") + deps(md, "build_requires") == complete
+
+    # Only BuildRequires depend on the selection
+    from rust2rpm.inspector import get_parser, inspect, parse_args
+    def inspector(*argv):
+        out = io.StringIO()
+        args = parse_args(get_parser(), list(argv) + [toml])
+        inspect(args, args.file, out=out)
+        return out.getvalue().splitlines()
+    assert inspector("-R") == complete + ["cargo"]
+    assert inspector("-R", "-F", "derive") == complete + ["cargo"]
+    assert [line.split(")")[0] for line in inspector("-BR", "--features", "derive,random")] == [
+        "((crate(libc", "(crate(rand", "((crate(serde", "(crate(serde_json", "(crate(cc",
+        "rust-packaging"]
+    assert inspector("-OR", "--no-default-features") == \
+        [str(dep) for dep in rust2rpm.Metadata.from_file(toml, default_features=False).optional_requires]
+
+    with pytest.raises(ValueError):
+        rust2rpm.Metadata.from_file(toml, features=["nope"])
+
+@pytest.mark.parametrize("target, arches", [
+    (None, ["x86_64", "i686", "armv7hl", "aarch64", "ppc64", "ppc64le", "s390x"]),
+    ("cfg(windows)", []),
+    ("cfg(unix)", ["x86_64", "i686", "armv7hl", "aarch64", "ppc64", "ppc64le", "s390x"]),
+    ('cfg(target_os = "macos")', []),
+    ('cfg(all(target_arch = "wasm32", not(target_os = "emscripten")))', []),
+    ('cfg(any(target_arch = "x86", target_arch = "x86_64"))', ["x86_64", "i686"]),
+    ('cfg(all(unix, target_pointer_width = "32"))', ["i686", "armv7hl"]),
+    ('cfg(not(target_endian = "big"))', ["x86_64", "i686", "armv7hl", "aarch64", "ppc64le"]),
+    ('cfg(target_feature = "sse2")', ["x86_64", "i686"]),
+    ("powerpc64le-unknown-linux-gnu", ["ppc64le"]),
+    ("x86_64-pc-windows-msvc", []),
+])
+def test_target_arches(target, arches):
+    from rust2rpm.cfg import target_arches
+
+    assert list(target_arches(target)) == arches
+
+def test_rust_arches():
+    from rust2rpm.cfg import RUST_ARCHES, parse_cfg
+
+    with open(os.path.join(os.path.dirname(__file__), "data", "macros.rust-srpm")) as fobj:
+        macros = dict(line.split(None, 1) for line in fobj if line.strip())
+    assert list(RUST_ARCHES) == macros["%rust_arches"].split()
+    with pytest.raises(ValueError):
+        parse_cfg("cfg(any(unix)")
+
+FOREIGN_TOML = """\
+[package]
+name = "c"
+version = "0.1.0"
+
+[dependencies.libc]
+version = "0.2"
+
+[target."cfg(windows)".dependencies.winapi]
+version = "0.3"
+features = [
+    "std",
+]
+
+[target.'cfg(unix)'.dependencies]
+nix = "0.26"
+
+[target.x86_64-pc-windows-msvc.build-dependencies]
+cc = "1"
+
+[target."cfg(any(windows, target_os = \\"macos\\"))".dependencies.core-foundation]
+version = "0.9"
+
+[features]
+default = []
+"""
+
+def test_drop_foreign_targets():
+    from rust2rpm.metadata import drop_foreign_targets
+
+    assert drop_foreign_targets(FOREIGN_TOML) == """\
+[package]
+name = "c"
+version = "0.1.0"
+
+[dependencies.libc]
+version = "0.2"
+
+[target.'cfg(unix)'.dependencies]
+nix = "0.26"
+
+[features]
+default = []
+"""
+    toml = "[package]\nname = \"c\"\n"
+    assert drop_foreign_targets(toml) is toml
+
+@pytest.mark.skipif(shutil.which("cargo") is None or shutil.which("patch") is None,
+                    reason="needs cargo and patch")
+def test_foreign_targets_patch(tmpdir):
+    from rust2rpm.__main__ import foreign_targets_patch
+
+    toml = FOREIGN_TOML.replace('[dependencies.libc]\nversion = "0.2"\n\n', "") \
+                       .replace("[target.'cfg(unix)'.dependencies]\nnix = \"0.26\"\n\n", "")
+    cratef = os.path.join(str(tmpdir), "c-0.1.0.crate")
+    with open(cratef, "wb") as fobj:
+        fobj.write(make_crate("c", "0.1.0", toml=toml, files=[("src/lib.rs", DUMMY_LIB)]))
+    patch_file, diff = foreign_targets_patch(cratef, "c", "0.1.0")
+    assert patch_file == "c-0.1.0-fix-metadata.diff"
+
+    # What the spec does: %autosetup -n %{crate}-%{version} -p1, %cargo_prep
+    # against an (empty) local registry, then resolve offline
+    with tarfile.open(cratef) as archive:
+        archive.extractall(str(tmpdir))
+    srcdir = os.path.join(str(tmpdir), "c-0.1.0")
+    registry = os.path.join(str(tmpdir), "registry")
+    os.mkdir(registry)
+    with open(os.path.join(os.path.dirname(__file__), "data", "macros.cargo")) as fobj:
+        macros = fobj.read()
+    body = macros.split("%cargo_prep (\\\n", 1)[1].split("\n)\n", 1)[0]
+    script = []
+    skipping = False
+    for line in body.split("\n"):
+        line = line[:-1] if line.endswith("\\") else line
+        if line.startswith("%if "):
+            # %{with check}
+            skipping = "!" in line
+        elif line.startswith("%endif"):
+            skipping = False
+        elif not skipping:
+            script.append(line)
+    script = "\n".join(script)
+    for macro, value in (("%{__mkdir}", "mkdir"), ("%{__rm}", "rm"), ("%{__awk}", "awk"),
+                         ("%{__rustc}", "rustc"), ("%{__rustdoc}", "rustdoc"),
+                         ("%{__global_rustflags_toml}", "[]"), ("%{cargo_registry}", registry)):
+        script = script.replace(macro, value)
+    assert "%" not in script
+    subprocess.check_call(["bash", "-c", script], cwd=srcdir)
+
+    def resolve():
+        proc = subprocess.Popen(["cargo", "generate-lockfile", "--offline"], cwd=srcdir,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                universal_newlines=True)
+        stderr = proc.communicate()[1]
+        return proc.returncode, stderr
+    status, stderr = resolve()
+    assert status != 0
+    assert "no matching package named" in stderr
+    proc = subprocess.Popen(["patch", "-p1"], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            cwd=srcdir, universal_newlines=True)
+    proc.communicate("".join(diff))
+    assert proc.returncode == 0
+    status, stderr = resolve()
+    assert status == 0, stderr
+
+def test_read_manifest_targets(cargo_toml):
+    toml = cargo_toml("""
+                      [package]
+                      name = "hello-world"
+                      version = "1.0.0"
+                      edition = "2018"
+                      autobenches = false
+
+                      [lib]
+                      proc-macro = true
+
+                      [[bin]]
+                      name = "extra"
+                      path = "src/extra.rs"
+                      """)
+    srcdir = os.path.join(os.path.dirname(toml), "src")
+    os.mkdir(os.path.join(srcdir, "bin"))
+    os.mkdir(os.path.join(srcdir, "..", "tests"))
+    os.mkdir(os.path.join(srcdir, "..", "benches"))
+    for name in ("main.rs", "extra.rs", "bin/tool.rs", "../build.rs", "../tests/t.rs", "../benches/b.rs"):
+        with open(os.path.join(srcdir, name), "w") as fobj:
+            fobj.write("fn main() {}\n")
+    native = rust2rpm.metadata.toml_read_manifest(toml)
+    cargo = rust2rpm.metadata.cargo_read_manifest(toml)
+    for md in (native, cargo):
+        assert [(tgt["kind"], tgt["name"]) for tgt in md["targets"]] == [
+            (["proc-macro"], "hello_world"),
+            (["bin"], "extra"),
+            (["bin"], "hello-world"),
+            (["bin"], "tool"),
+            (["test"], "t"),
+            (["custom-build"], "build-script-build")]
+
+def test_metadata_cache(cargo_toml, tmpdir):
+    from rust2rpm.cache import MetadataCache, manifest_key
+
+    toml = cargo_toml("""
+                      [package]
+                      name = "hello"
+                      version = "1.2.3"
+                      """)
+    cache = MetadataCache(str(tmpdir), max_size=1)
+    key = manifest_key(toml)
+    assert cache.get(key) is None
+    md = cache.from_file(toml)
+    assert md.provides == ("crate(hello) = 1.2.3",)
+    assert cache.get(key).provides == md.provides
+    # Targets are part of the key
+    os.mkdir(os.path.join(os.path.dirname(toml), "src", "bin"))
+    open(os.path.join(os.path.dirname(toml), "src", "bin", "hello.rs"), "w").close()
+    assert manifest_key(toml) != key
+    # Over the size limit, only the most recently stored entry survives
+    cache.from_file(toml)
+    assert cache.get(key) is None
+    assert len(list(cache.entries())) == 1
+
+    # Under the limit, storing an entry only updates the recorded total
+    def size():
+        with open(os.path.join(str(tmpdir), "size")) as fobj:
+            return int(fobj.read())
+    assert size() == sum(size for _, size, _ in cache.entries())
+    cache.max_size = 1024 * 1024
+    cache.entries = None
+    cache.put("0" * 64, {"name": "other", "version": "1.0.0", "license": None, "license_file": None,
+                         "targets": [], "features": {}, "dependencies": []})
+    del cache.entries
+    assert size() == sum(size for _, size, _ in cache.entries())
+
+    # An unusable cache directory only costs a warning
+    blocker = os.path.join(str(tmpdir), "blocker")
+    open(blocker, "w").close()
+    env = dict(os.environ, XDG_CACHE_HOME=blocker)
+    proc = subprocess.Popen([sys.executable, "-m", "rust2rpm.inspector", "-P", toml, toml],
+                            env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    stdout, stderr = proc.communicate()
+    assert proc.returncode == 0
+    assert stdout == "crate(hello) = 1.2.3\n" * 2
+    assert stderr.count("warning: not caching metadata") == 1
+
+def test_read_batch():
+    from rust2rpm.__main__ import read_batch
+
+    lines = ["# mass rebuild\n", "serde@1.0.0\n", "\n", "  rand  # latest\n"]
+    assert list(read_batch(lines)) == [("serde", "1.0.0"), ("rand", None)]
+
+@pytest.fixture
+def crates_io(request):
+    registry = FakeRegistry()
+    registry.start()
+    request.addfinalizer(registry.stop)
+    return registry.api_url, registry.add, registry.hits
+
+def test_downloader(crates_io, tmpdir):
+    from rust2rpm.registry import Downloader
+
+    url, add, hits = crates_io
+    for i in range(20):
+        add("crate{}".format(i), "1.0.{}".format(i % 3))
+    add("crate0", "0.9.0")
+
+    downloader = Downloader(api_url=url, cachedir=str(tmpdir), jobs=4, progress=False)
+    entries = [("crate{}".format(i), None) for i in range(20)] + [("missing", "1.0.0")]
+    results = downloader.fetch_many(entries)
+    assert results[0] == (os.path.join(str(tmpdir), "crate0-1.0.0.crate"), "crate0", "1.0.0")
+    for i, result in enumerate(results[:20]):
+        assert result[2] == "1.0.{}".format(i % 3)
+        with tarfile.open(result[0]) as archive:
+            assert archive.getnames() == ["crate{}-{}/Cargo.toml".format(i, result[2])]
+    assert isinstance(results[20], Exception)
+
+    # Already downloaded crates are not fetched again
+    del hits[:]
+    assert downloader.fetch("crate1", "1.0.1")[0] == results[1][0]
+    assert hits == []
+
+def test_download_cache(tmpdir):
+    from rust2rpm.registry import Downloader
+
+    registry = FakeRegistry()
+    registry.start()
+    try:
+        for name in ("a", "b", "c"):
+            registry.add(name, "1.0.0", padding=20000, seed=ord(name))
+        data = registry.crates["a"]["1.0.0"]
+        cachedir = str(tmpdir)
+        cratef = os.path.join(cachedir, "a-1.0.0.crate")
+
+        def downloader(**kwargs):
+            return Downloader(api_url=registry.api_url, cachedir=cachedir, progress=False, **kwargs)
+
+        # Requirements pick the newest matching version
+        registry.add("a", "1.1.0")
+        registry.add("a", "2.0.0-rc.1")
+        assert downloader().select_version("a", "^1") == "1.1.0"
+        assert downloader().latest_version("a") == "1.1.0"
+        with pytest.raises(LookupError):
+            downloader().select_version("a", ">=3")
+
+        # Interrupted downloads resume, a broken prefix is downloaded again
+        for prefix in (data[:5000], b"garbage"):
+            with open(cratef + ".part", "wb") as fobj:
+                fobj.write(prefix)
+            downloader().fetch("a", "1.0.0")
+            with open(cratef, "rb") as fobj:
+                assert fobj.read() == data
+            assert not os.path.exists(cratef + ".part")
+            os.unlink(cratef)
+
+        # Concurrent fetches of the same crate download it once
+        del registry.hits[:]
+        threads = [threading.Thread(target=downloader().fetch, args=("a", "1.0.0"))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert registry.hits.count("/api/v1/crates/a/1.0.0/download") == 1
+
+        # Crates not matching the registry checksum are never stored
+        d = downloader()
+        d.versions("b")
+        registry.crates["b"]["1.0.0"] = registry.crates["c"]["1.0.0"]
+        with pytest.raises(ValueError):
+            d.fetch("b", "1.0.0")
+        assert not os.path.exists(os.path.join(cachedir, "b-1.0.0.crate"))
+        assert not os.path.exists(os.path.join(cachedir, "b-1.0.0.crate.part"))
+
+        # Least recently used crates are evicted beyond max_size
+        os.utime(cratef, (0, 0))
+        downloader(max_size=len(data) + 100).fetch("c", "1.0.0")
+        assert sorted(f for f in os.listdir(cachedir) if f.endswith(".crate")) == ["c-1.0.0.crate"]
+
+        # Under the limit, a fetch only updates the recorded total
+        def size():
+            with open(os.path.join(cachedir, "size")) as fobj:
+                return int(fobj.read())
+        d = downloader(max_size=10 * len(data))
+        assert size() == sum(size for _, size, _ in d.entries())
+        d.entries = None
+        d.fetch("a", "1.0.0")
+        del d.entries
+        assert size() == sum(size for _, size, _ in d.entries())
+    finally:
+        registry.stop()
+
+def test_crate_read_manifest(tmpdir):
+    toml = """
+           [package]
+           name = "hello"
+           version = "0.1.0"
+
+           [build-dependencies]
+           cc = "1"
+           """
+    cratef = os.path.join(str(tmpdir), "hello-0.1.0.crate")
+    with open(cratef, "wb") as fobj:
+        fobj.write(make_crate("hello", "0.1.0", toml=textwrap.dedent(toml),
+                              files=[("src/lib.rs", DUMMY_LIB),
+                                     ("src/bin/hello.rs", "fn main() {}"),
+                                     ("vendor/big.c", "int x;" * 1000),
+                                     ("build.rs", "fn main() {}")]))
+    manifest = rust2rpm.metadata.crate_read_manifest(cratef, "hello-0.1.0")
+    md = rust2rpm.Metadata.from_json(manifest)
+    assert [(tgt.kind, tgt.name) for tgt in md.targets] == [
+        ("lib", "hello"), ("bin", "hello"), ("custom-build", "build-script-build")]
+    assert [str(x) for x in md.build_requires] == [
+        "(crate(cc) >= 1.0.0 with crate(cc) < 2.0.0)"]
+    assert os.listdir(str(tmpdir)) == ["hello-0.1.0.crate"]
+
+def test_resolver(crates_io, tmpdir):
+    from rust2rpm.registry import Downloader
+    from rust2rpm.resolver import Resolver
+
+    url, add, hits = crates_io
+
+    def add_with_deps(name, version, *deps):
+        toml = '[package]\nname = "{}"\nversion = "{}"\n[dependencies]\n'.format(name, version)
+        toml += "".join('{} = "{}"\n'.format(*dep) for dep in deps)
+        add(name, version, toml=toml, files=[("src/lib.rs", DUMMY_LIB)])
+
+    add_with_deps("app", "1.0.0", ("a", "1"), ("b", "0.2"), ("old", "0.1"))
+    add_with_deps("a", "1.0.0")
+    add_with_deps("a", "1.1.0", ("c", "=0.1.0"))
+    add_with_deps("a", "2.0.0")
+    add_with_deps("b", "0.2.3", ("c", "0.1"), ("old", "0.2"))
+    add_with_deps("b", "0.3.0")
+    add_with_deps("c", "0.1.0")
+    add_with_deps("c", "0.1.5")
+    add_with_deps("c", "0.2.0-alpha")
+    add_with_deps("old", "0.1.1")
+    add_with_deps("old", "0.2.0")
+
+    def load(cratef, crate, version, **kwargs):
+        return rust2rpm.Metadata.from_json(
+            rust2rpm.metadata.crate_read_manifest(cratef, "{}-{}".format(crate, version)), **kwargs)
+
+    downloader = Downloader(api_url=url, cachedir=str(tmpdir), progress=False)
+    resolver = Resolver(downloader, load)
+    resolver.resolve("app")
+    order = [(node.name, node.version) for node in resolver.build_order()]
+    assert order == [("c", "0.1.0"), ("old", "0.1.1"), ("old", "0.2.0"),
+                     ("a", "1.1.0"), ("b", "0.2.3"), ("app", "1.0.0")]
+    assert resolver.warnings == []
+
+    # Optional dependencies come in with the features dependents ask for,
+    # even when those are only known once the crate has been loaded
+    add("s", "1.0.0", files=[("src/lib.rs", DUMMY_LIB)], toml=textwrap.dedent("""
+        [package]
+        name = "s"
+        version = "1.0.0"
+        [dependencies]
+        s_derive = { version = "1", optional = true }
+        unpublished = { version = "1", optional = true }
+        [features]
+        derive = ["s_derive"]
+        """))
+    add_with_deps("s_derive", "1.0.0")
+    add_with_deps("m", "1.0.0")
+    add("m", "1.1.0", files=[("src/lib.rs", DUMMY_LIB)],
+        toml='[package]\nname = "m"\nversion = "1.1.0"\n[dependencies]\n'
+             's = { version = "1", features = ["derive"] }\n')
+    add_with_deps("app2", "1.0.0", ("s", "1"), ("m", "1"))
+    resolver = Resolver(downloader, load)
+    resolver.resolve("app2")
+    order = [(node.name, node.version) for node in resolver.build_order()]
+    assert order == [("s_derive", "1.0.0"), ("s", "1.0.0"), ("m", "1.1.0"), ("app2", "1.0.0")]
+    assert resolver.nodes[("s", "1")].features == {"derive"}
+    assert resolver.warnings == []
+
+    resolver = Resolver(downloader, load)
+    resolver.resolve("s", features=["derive"])
+    assert [node.name for node in resolver.build_order()] == ["s_derive", "s"]
+
+def test_recursive(crates_io, tmpdir, monkeypatch):
+    import argparse
+    from rust2rpm import __main__
+    from rust2rpm.registry import Downloader
+
+    url, add, hits = crates_io
+    lib = [("src/lib.rs", DUMMY_LIB)]
+    add("app", "1.0.0", [("old", "0.1"), ("b", "1")], files=lib)
+    add("b", "1.0.0", [("old", "0.2")], files=lib)
+    add("old", "0.1.1", files=lib)
+    add("old", "0.2.0", files=lib)
+    monkeypatch.setattr(__main__, "make_downloader", lambda args: Downloader(
+        api_url=url, cachedir=str(tmpdir), progress=False))
+    monkeypatch.chdir(str(tmpdir))
+
+    args = argparse.Namespace(crate="app", version=None, no_cache=True, jobs=2, stdout=False,
+                              features=[], all_features=False, no_default_features=False)
+    target_kwargs = __main__.get_target_kwargs("fedora")
+    target_kwargs.update(date="Thu Jan 01 2026", arch_conditional=False)
+    __main__.recursive(args, __main__.get_jinja_env().get_template("main.spec"), target_kwargs)
+
+    def name(spec):
+        with open(spec) as fobj:
+            return [line for line in fobj if line.startswith("Name:")]
+    # The older series must not take the name of the newer one's package
+    assert name("rust-old.spec") == ["Name:           rust-%{crate}\n"]
+    assert name("rust-old0.1.spec") == ["Name:           rust-%{crate}0.1\n"]
+    with open("rust-old0.1.spec") as fobj:
+        assert "Version:        0.1.1\n" in fobj.read()
+
+def test_index(crates_io, tmpdir):
+    from rust2rpm.registry import Index, index_path
+
+    url, add, hits = crates_io
+    for version in ("0.9.0", "1.10.0", "1.2.0"):
+        add("libc", version)
+    index_url = url.replace("/api/v1/", "/index/")
+    cachedir = os.path.join(str(tmpdir), "cache")
+
+    index = Index(index_url, cachedir=cachedir, ttl=0)
+    assert index.versions("libc") == ["1.10.0", "1.2.0", "0.9.0"]
+    assert hits == ["/index/li/bc/libc"]
+    # Revalidated, not downloaded again
+    add("libc", "1.11.0")
+    index = Index(index_url, cachedir=cachedir, ttl=0)
+    assert index.versions("libc")[0] == "1.11.0"
+    index = Index(index_url, cachedir=cachedir, ttl=0)
+    assert index.versions("libc")[0] == "1.11.0"
+    assert len(hits) == 3
+    # Offline mode only looks at the cache
+    del hits[:]
+    index = Index(index_url, cachedir=cachedir, offline=True)
+    assert index.versions("libc")[0] == "1.11.0"
+    with pytest.raises(LookupError):
+        index.versions("serde")
+    assert hits == []
+
+    # A local mirror directory works without any server
+    assert index_path("a") == "1/a"
+    assert index_path("cc") == "2/cc"
+    assert index_path("Syn") == "3/s/syn"
+    assert index_path("serde") == "se/rd/serde"
+    mirror = os.path.join(str(tmpdir), "mirror")
+    shutil.copytree(cachedir, mirror)
+    assert Index(mirror).versions("libc") == ["1.11.0", "1.10.0", "1.2.0", "0.9.0"]
+
+def test_inspector_structured(cargo_toml):
+    from rust2rpm import inspector
+
+    toml = cargo_toml("""
+                      [package]
+                      name = "hello"
+                      version = "1.2.3"
+
+                      [dependencies]
+                      libc = "0.2"
+                      """)
+    parser = inspector.get_parser()
+
+    out = io.StringIO()
+    args = inspector.parse_args(parser, ["--json", "-n", "-v", "-t", "-R", "--no-cache", toml])
+    inspector.inspect(args, [toml], out)
+    assert json.loads(out.getvalue()) == {
+        "name": "hello", "version": "1.2.3", "target_kinds": ["lib"],
+        "requires": ["(crate(libc) >= 0.2.0 with crate(libc) < 0.3.0)"]}
+
+    out = io.StringIO()
+    args = inspector.parse_args(parser, ["--shell", "-n", "-v", "-t", "--no-cache", toml])
+    inspector.inspect(args, [toml], out)
+    assert out.getvalue() == "CRATE_NAME=hello\nCRATE_VERSION=1.2.3\nCRATE_TARGET_KINDS=lib\n"
+
+    with pytest.raises(SystemExit):
+        inspector.parse_args(parser, ["-n", "-v", toml])
+
+def test_workspace(tmpdir):
+    from rust2rpm import inspector
+
+    root = str(tmpdir)
+    members = {
+        "core": '[package]\nname = "ws-core"\nversion = "0.3.1"\n',
+        "app": '[package]\nname = "ws-app"\nversion = "1.0.0"\n[dependencies]\n'
+               'ws-core = { path = "../core" }\nlibc = "0.2"\n',
+        "macros": '[package]\nname = "ws-macros"\nversion = "1.0.0"\n'
+                  '[dependencies]\nws-core = { path = "../core", version = "0.3" }\n'
+                  '[dev-dependencies]\nws-app = { path = "../app" }\n',
+    }
+    with open(os.path.join(root, "Cargo.toml"), "w") as fobj:
+        fobj.write('[workspace]\nmembers = ["app", "core", "macros"]\n')
+    for member, toml in members.items():
+        os.makedirs(os.path.join(root, member, "src"))
+        with open(os.path.join(root, member, "Cargo.toml"), "w") as fobj:
+            fobj.write(toml)
+        with open(os.path.join(root, member, "src", "lib.rs"), "w") as fobj:
+            fobj.write(DUMMY_LIB)
+
+    mds = rust2rpm.Metadata.from_workspace(os.path.join(root, "Cargo.toml"))
+    assert [md.name for md in mds] == ["ws-core", "ws-app", "ws-macros"]
+    assert [str(dep) for dep in mds[1].requires] == [
+        "(crate(libc) >= 0.2.0 with crate(libc) < 0.3.0)",
+        "(crate(ws-core) >= 0.3.1 with crate(ws-core) < 0.4.0)"]
+    assert [str(dep) for dep in mds[2].requires] == [
+        "(crate(ws-core) >= 0.3.0 with crate(ws-core) < 0.4.0)"]
+
+    out = io.StringIO()
+    args = inspector.parse_args(inspector.get_parser(),
+                                ["--json", "-n", "-v", "--workspace", os.path.join(root, "Cargo.toml")])
+    inspector.inspect(args, args.file, out)
+    assert [json.loads(line) for line in out.getvalue().splitlines()] == [
+        {"name": "ws-core", "version": "0.3.1"},
+        {"name": "ws-app", "version": "1.0.0"},
+        {"name": "ws-macros", "version": "1.0.0"}]
+
+@pytest.mark.parametrize("mode", ["auto", "hardlink", "copy"])
+def test_install(tmpdir, mode):
+    from rust2rpm.install import install
+
+    src = os.path.join(str(tmpdir), "src")
+    files = {"Cargo.toml": '[package]\nname = "hello"\nversion = "1.0.0"\n',
+             "Cargo.toml.orig": '[package]\nname = "hello"\nversion = "1.0.0"\n# orig\n',
+             "src/lib.rs": DUMMY_LIB,
+             "src/empty.rs": "",
+             "tests/data/big.bin": "x" * 100000}
+    for name, contents in files.items():
+        os.makedirs(os.path.dirname(os.path.join(src, name)), exist_ok=True)
+        with open(os.path.join(src, name), "w") as fobj:
+            fobj.write(contents)
+
+    dest = os.path.join(str(tmpdir), "registry", "hello-1.0.0")
+    names = ["Cargo.toml", "src/lib.rs", "src/empty.rs", "tests/data/big.bin"]
+    methods = install(src, dest, names, manifest=os.path.join(src, "Cargo.toml.orig"),
+                      mode=mode, jobs=2)
+    assert sum(methods.values()) == 4
+    if mode != "auto":
+        assert list(methods) == [mode]
+
+    with open(os.path.join(dest, ".cargo-checksum.json")) as fobj:
+        checksums = json.load(fobj)
+    assert checksums["package"] == ""
+    assert sorted(checksums["files"]) == sorted(names)
+    for name in names:
+        with open(os.path.join(dest, name), "rb") as fobj:
+            assert checksums["files"][name] == hashlib.sha256(fobj.read()).hexdigest()
+    with open(os.path.join(dest, "Cargo.toml")) as fobj:
+        assert fobj.read().endswith("# orig\n")
+
+def test_scan_registry(tmpdir):
+    from rust2rpm import inspector
+
+    registry = str(tmpdir)
+    for name, deps in (("foo", 'libc = "0.2"\n'), ("bar", "")):
+        os.makedirs(os.path.join(registry, "{}-1.0.0".format(name), "src"))
+        with open(os.path.join(registry, "{}-1.0.0".format(name), "Cargo.toml"), "w") as fobj:
+            fobj.write('[package]\nname = "{}"\nversion = "1.0.0"\n'
+                       '[dependencies]\n{}'.format(name, deps))
+    out = io.StringIO()
+    args = inspector.parse_args(inspector.get_parser(),
+                                ["--registry", registry, "--no-cache", "-j", "2"])
+    assert inspector.scan_registry(args, out) == 0
+    records = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [(r["name"], r["provides"], r["requires"]) for r in records] == [
+        ("bar", ["crate(bar) = 1.0.0"], []),
+        ("foo", ["crate(foo) = 1.0.0"], ["(crate(libc) >= 0.2.0 with crate(libc) < 0.3.0)"])]
+
+@pytest.mark.parametrize("module, lazy", [
+    ("rust2rpm.inspector_client", ["rust2rpm.metadata", "semantic_version"]),
+    ("rust2rpm.inspector", ["jinja2", "requests", "tqdm", "multiprocessing", "socketserver"]),
+    ("rust2rpm.__main__", ["jinja2", "requests", "tqdm"]),
+])
+def test_startup(module, lazy):
+    code = textwrap.dedent("""
+        import json, sys, time
+        start = time.perf_counter()
+        import {}
+        print(json.dumps([time.perf_counter() - start, sorted(sys.modules)]))
+        """.format(module))
+    output = subprocess.check_output([sys.executable, "-c", code],
+                                     cwd=os.path.dirname(os.path.abspath(__file__)))
+    elapsed, modules = json.loads(output.decode("utf-8"))
+    assert [m for m in lazy if m in modules] == []
+    assert elapsed < IMPORT_BUDGET
+
+def test_timings(cargo_toml):
+    from rust2rpm.timing import TIMINGS
+
+    TIMINGS.reset()
+    rust2rpm.Metadata.from_file(cargo_toml("""
+                                           [package]
+                                           name = "hello"
+                                           version = "1.2.3"
+                                           """))
+    TIMINGS.add_bytes("download", 1024)
+    data = TIMINGS.as_dict()
+    assert list(data["phases"]) == ["parse", "metadata", "download"]
+    assert data["phases"]["parse"]["count"] == 1
+    assert data["phases"]["download"] == {"count": 0, "wall": 0.0, "cpu": 0.0, "bytes": 1024}
+    out = io.StringIO()
+    TIMINGS.report("json", out)
+    assert json.loads(out.getvalue())["phases"]["metadata"]["count"] == 1
+
+    import argparse
+    from rust2rpm import timing
+    parser = argparse.ArgumentParser()
+    timing.add_arguments(parser)
+    parser.add_argument("crate", nargs="?")
+    args = parser.parse_args(["--timings", "serde"])
+    assert (args.timings, args.timings_format, args.crate) == (True, None, "serde")
+    args = parser.parse_args(["--timings-format", "json", "serde"])
+    assert (args.timings_format, args.crate) == ("json", "serde")
+
+def test_inspector_server(cargo_toml):
+    from rust2rpm import inspector_client, server as inspector_server
+
+    toml = cargo_toml("""
+                      [package]
+                      name = "hello"
+                      version = "1.2.3"
+
+                      [dependencies]
+                      libc = "0.2"
+                      """)
+    sock = os.path.join(os.path.dirname(toml), "inspector.sock")
+    server = inspector_server.InspectorServer(sock, rust2rpm.Metadata.from_file)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        for _ in range(2):
+            response = inspector_client.query(sock, ["--requires", toml])
+            assert response["status"] == 0
+            assert response["stdout"].splitlines() == [
+                "(crate(libc) >= 0.2.0 with crate(libc) < 0.3.0)",
+                "cargo"]
+        response = inspector_client.query(sock, ["--provides"], stdin=toml + "\n")
+        assert response["stdout"] == "crate(hello) = 1.2.3\n"
+        response = inspector_client.query(sock, [toml])
+        assert response["status"] == 2
+        assert "one of the query arguments is required" in response["stderr"]
+        assert len(server.cache._entries) == 1
+
+        # Concurrent requests each get their own usage errors
+        stderr = sys.stderr
+        responses = {}
+
+        def bad_query(i):
+            responses[i] = inspector_client.query(sock, ["--name", "--bogus{}".format(i), toml])
+        threads = [threading.Thread(target=bad_query, args=(i,)) for i in range(64)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # None of them was turned away
+        assert len(responses) == len(threads)
+        for i, response in responses.items():
+            assert response["status"] == 2
+            assert re.findall(r"--bogus\d+", response["stderr"]) == ["--bogus{}".format(i)]
+        assert sys.stderr is stderr
+
+        # Only a server run by the same user is trusted
+        getuid = os.getuid
+        try:
+            os.getuid = lambda: getuid() + 1
+            with pytest.raises(PermissionError):
+                inspector_client.query(sock, ["--name", toml])
+        finally:
+            os.getuid = getuid
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+    # A stalled server makes the client give up
+    os.unlink(sock)
+    stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        stalled.bind(sock)
+        stalled.listen(1)
+        with pytest.raises(OSError):
+            inspector_client.query(sock, ["--name", toml], timeout=0.2)
+    finally:
+        stalled.close()
+        os.unlink(sock)
+
+def test_default_socket(monkeypatch):
+    from rust2rpm.inspector_client import SOCKET_ENV, default_socket
+
+    monkeypatch.delenv(SOCKET_ENV, raising=False)
+    monkeypatch.setenv("XDG_RUNTIME_DIR", "/run/user/1000")
+    assert default_socket() == "/run/user/1000/cargo-inspector.sock"
+    # Never a shared directory
+    monkeypatch.delenv("XDG_RUNTIME_DIR")
+    monkeypatch.setenv("TMPDIR", "/tmp")
+    assert default_socket() is None
+    monkeypatch.setenv(SOCKET_ENV, "/srv/inspector.sock")
+    assert default_socket() == "/srv/inspector.sock"
+
+def test_update_spec():
+    from rust2rpm.__main__ import get_jinja_env, get_target_kwargs, make_changelog, render_spec
+    from rust2rpm.update import update_spec
+
+    def metadata(version, deps):
+        return rust2rpm.Metadata.from_json({
+            "name": "hello", "version": version, "license": "MIT", "license_file": None,
+            "description": "Hello", "features": {},
+            "targets": [{"kind": ["lib"], "name": "hello"}],
+            "dependencies": [{"name": name, "req": req, "kind": kind, "rename": None,
+                              "optional": False, "features": [], "target": None}
+                             for name, req, kind in deps],
+        })
+
+    env = get_jinja_env()
+    template = env.get_template("main.spec")
+    target_kwargs = get_target_kwargs("fedora")
+    target_kwargs.update(date="Thu Jan 01 2026", packager="Jane Doe <jane@example.com>")
+    old_md = metadata("1.0.0", [("libc", "^0.2", None), ("rand", "^0.7", "dev")])
+    old = render_spec(template, old_md, target_kwargs)
+    # Local changes of the packager
+    old = old.replace("Release:        1%{?dist}", "Release:        3%{?dist}")
+    old = old.replace("BuildRequires:  (crate(libc)",
+                      "BuildRequires:  pkgconfig(openssl)\nBuildRequires:  (crate(libc)")
+    old = old.replace("%cargo_build", "%cargo_build -a")
+    changelog = make_changelog(env.get_template("fedora-update-changelog.spec.inc"),
+                               old_md, target_kwargs)
+    assert update_spec(old, render_spec(template, old_md, target_kwargs), changelog) == (old, False)
+
+    new_md = metadata("1.1.0", [("libc", "^0.2.5", None), ("serde", "^1", "build")])
+    new = render_spec(template, new_md, target_kwargs)
+    changelog = make_changelog(env.get_template("fedora-update-changelog.spec.inc"),
+                               new_md, target_kwargs)
+    updated, changed = update_spec(old, new, changelog)
+    assert changed
+    assert updated.replace("%cargo_build -a", "%cargo_build").replace(
+        "BuildRequires:  pkgconfig(openssl)\n", "") == new.replace(
+        "1.1.0-1\n- Initial package", "1.0.0-1\n- Initial package").replace(
+        "%changelog\n", "%changelog\n"
+        "* Thu Jan 01 2026 Jane Doe <jane@example.com> - 1.1.0-1\n"
+        "- Update to version 1.1.0\n\n")
+    assert "BuildRequires:  pkgconfig(openssl)\n" in updated
+    assert "rand" not in updated
+
+    # Same version with other dependencies bumps the release
+    newer = render_spec(template, metadata("1.1.0", [("libc", "^0.2.7", None)]), target_kwargs)
+    updated, changed = update_spec(updated, newer, changelog)
+    assert changed
+    assert "Release:        2%{?dist}" in updated
+    assert "- 1.1.0-2\n- Regenerate dependencies\n" in updated
+    assert "crate(serde)" not in updated and "# [build-dependencies]" not in updated
+
+    # Commented out conditionals of optional requirements go with them
+    def optional_metadata(version, optional):
+        return rust2rpm.Metadata.from_json({
+            "name": "hello", "version": version, "license": "MIT", "license_file": None,
+            "description": "Hello", "features": {},
+            "targets": [{"kind": ["lib"], "name": "hello"}],
+            "dependencies": [{"name": "libc", "req": "^0.2", "kind": None, "rename": None,
+                              "optional": False, "features": [], "target": None}] +
+                            [{"name": name, "req": "^1", "kind": None, "rename": None,
+                              "optional": True, "features": [], "target": target}
+                             for name, target in optional],
+        })
+
+    for target in ("fedora", "plain", "opensuse", "mageia"):
+        target_kwargs = get_target_kwargs(target)
+        target_kwargs.update(date="Thu Jan 01 2026", arch_conditional=True)
+        old = render_spec(template, optional_metadata("1.0.0", [
+            ("cpuid", 'cfg(target_arch = "x86_64")'), ("rayon", None)]), target_kwargs)
+        assert "#%ifarch x86_64\n#BuildRequires:  (crate(cpuid)" in old
+        new = render_spec(template, optional_metadata("1.1.0", [("rayon", None)]), target_kwargs)
+        updated, changed = update_spec(old, new)
+        assert changed
+        assert "#%ifarch" not in updated and "#%endif" not in updated
+        assert updated.split("%description")[0] == new.split("%description")[0]
+
+def test_capabilities(tmpdir):
+    import gzip
+    from rust2rpm.cache import MetadataCache
+    from rust2rpm.capabilities import Capabilities
+
+    primary = os.path.join(str(tmpdir), "primary.xml.gz")
+    with gzip.open(primary, "wt") as fobj:
+        fobj.write(textwrap.dedent("""\
+            <?xml version="1.0" encoding="UTF-8"?>
+            <metadata xmlns="http://linux.duke.edu/metadata/common"
+                      xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="1">
+            <package type="rpm"><name>rust-libc-devel</name><format><rpm:provides>
+              <rpm:entry name="crate(libc)" flags="EQ" epoch="0" ver="0.2.80" rel="1.fc40"/>
+              <rpm:entry name="crate(libc/std)" flags="EQ" epoch="0" ver="0.2.80" rel="1.fc40"/>
+              <rpm:entry name="rust-libc-devel" flags="EQ" epoch="0" ver="0.2.80" rel="1.fc40"/>
+            </rpm:provides></format></package>
+            </metadata>
+            """))
+    provides = os.path.join(str(tmpdir), "provides.txt")
+    with open(provides, "w") as fobj:
+        fobj.write("crate(rand) = 0.8.5\ncrate(rand/std) = 0.8.5\ncrate(bitflags) = 2.0.0~rc.1\n")
+    registry = os.path.join(str(tmpdir), "registry")
+    os.makedirs(os.path.join(registry, "log-0.4.20", "src"))
+    with open(os.path.join(registry, "log-0.4.20", "Cargo.toml"), "w") as fobj:
+        fobj.write('[package]\nname = "log"\nversion = "0.4.20"\n[features]\nstd = []\n')
+    open(os.path.join(registry, "log-0.4.20", "src", "lib.rs"), "w").close()
+
+    caps = Capabilities()
+    caps.add_primary(primary)
+    caps.add_provides(provides)
+    caps.add_registry(registry, cache=MetadataCache(str(tmpdir.join("cache"))))
+    index = os.path.join(str(tmpdir), "capabilities.json.gz")
+    caps.save(index)
+    caps = Capabilities.load(index)
+    assert caps.crates == {"libc": {"0.2.80"}, "libc/std": {"0.2.80"},
+                           "rand": {"0.8.5"}, "rand/std": {"0.8.5"},
+                           "bitflags": {"2.0.0-rc.1"},
+                           "log": {"0.4.20"}, "log/std": {"0.4.20"}}
+
+    deps = [rust2rpm.Dependency("libc", "^0.2", features=["std"]),
+            rust2rpm.Dependency("libc", "^0.3"),
+            rust2rpm.Dependency("rand", "^0.8", features=["small_rng"]),
+            rust2rpm.Dependency("log", "~0.4.14", features=["std"]),
+            rust2rpm.Dependency("bitflags", "^2"),
+            rust2rpm.Dependency("bitflags", "=2.0.0-rc.1"),
+            rust2rpm.Dependency("serde", "^1")]
+    assert [str(dep) for dep in caps.unsatisfied(deps)] == [
+        "(crate(libc) >= 0.3.0 with crate(libc) < 0.4.0)",
+        "((crate(rand) >= 0.8.0 with crate(rand) < 0.9.0) with crate(rand/small_rng))",
+        "(crate(bitflags) >= 2.0.0 with crate(bitflags) < 3.0.0)",
+        "(crate(serde) >= 1.0.0 with crate(serde) < 2.0.0)"]
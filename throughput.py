@@ -0,0 +1,97 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_registry import FakeRegistry, populate
+
+# End to end throughput of rust2rpm against a local stand-in for crates.io:
+# every crate is generated once per process (sequential) and all of them in
+# one --batch run. Each run starts with an empty cache.
+
+def run(argv, env, stdin=None):
+    # wait4 gives the rusage of this child alone; ru_maxrss is in KiB
+    start = time.perf_counter()
+    proc = subprocess.Popen(argv, env=env, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                            universal_newlines=True)
+    if stdin:
+        proc.stdin.write(stdin)
+    proc.stdin.close()
+    _, status, rusage = os.wait4(proc.pid, 0)
+    elapsed = time.perf_counter() - start
+    # os.waitstatus_to_exitcode only exists since Python 3.9
+    if os.WIFEXITED(status):
+        proc.returncode = os.WEXITSTATUS(status)
+    else:
+        proc.returncode = -os.WTERMSIG(status)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, argv)
+    return elapsed, rusage.ru_maxrss
+
+def rust2rpm_argv(registry, target, extra):
+    return [sys.executable, "-m", "rust2rpm", "--stdout", "-t", target,
+            "--api-url", registry.api_url, "--index", registry.index_url] + extra
+
+def make_env(cachedir):
+    env = dict(os.environ)
+    env["XDG_CACHE_HOME"] = cachedir
+    env["PYTHONPATH"] = os.path.dirname(os.path.abspath(__file__))
+    return env
+
+def sequential(registry, names, target):
+    elapsed = peak = 0
+    with tempfile.TemporaryDirectory() as cachedir:
+        env = make_env(cachedir)
+        for name in names:
+            t, rss = run(rust2rpm_argv(registry, target, [name]), env)
+            elapsed += t
+            peak = max(peak, rss)
+    return elapsed, peak
+
+def batched(registry, names, target, jobs):
+    with tempfile.TemporaryDirectory() as cachedir:
+        argv = rust2rpm_argv(registry, target, ["-j", str(jobs), "--batch=-"])
+        return run(argv, make_env(cachedir), stdin="".join(n + "\n" for n in names))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--crates", type=int, default=50,
+                        help="Number of synthetic crates")
+    parser.add_argument("--min-size", type=int, default=0,
+                        help="Smallest synthetic crate payload in bytes")
+    parser.add_argument("--max-size", type=int, default=256 * 1024,
+                        help="Largest synthetic crate payload in bytes")
+    parser.add_argument("-j", "--jobs", type=int, default=8)
+    parser.add_argument("-t", "--target", default="fedora")
+    parser.add_argument("--mode", choices=("sequential", "batch", "both"), default="both")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    registry = FakeRegistry()
+    names = populate(registry, args.crates, min_size=args.min_size, max_size=args.max_size)
+    registry.start()
+    try:
+        results = {}
+        if args.mode in ("sequential", "both"):
+            results["sequential"] = sequential(registry, names, args.target)
+        if args.mode in ("batch", "both"):
+            results["batch"] = batched(registry, names, args.target, args.jobs)
+    finally:
+        registry.stop()
+
+    report = {mode: {"crates": len(names), "seconds": elapsed,
+                     "crates_per_second": len(names) / elapsed, "peak_rss_kib": peak}
+              for mode, (elapsed, peak) in results.items()}
+    if args.json:
+        print(json.dumps(report, sort_keys=True))
+        return
+    for mode, result in sorted(report.items()):
+        print("{:<12} {:>5} crates {:>8.2f} s {:>8.1f} crates/s  peak RSS {:>8} KiB".format(
+              mode, result["crates"], result["seconds"], result["crates_per_second"],
+              result["peak_rss_kib"]))
+
+if __name__ == "__main__":
+    main()